@@ -5,19 +5,75 @@
 import getopt
 import sys
 import os
-import requests
-import urllib3
 import json
 import threading
+import base64
+import time
+import sqlite3
+import zlib
+import hashlib
+import codecs
+import csv
+import io
+import copy
+import collections
+import itertools
+import array
+import socket
+import signal
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 if sys.version_info < (3, 0):
     from urllib import urlencode
+    import SocketServer as socketserver
 else:
     from urllib.parse import urlencode
+    import socketserver
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# requests, urllib3 and numpy make up most of the start-up time, so they are imported on first use and
+# -h, daemon clients, offline queries and cached lookups never load them
+requests = None
+urllib3 = None
+HTTPAdapter = None
+Retry = None
+numpy = None
+
+def import_http():
+
+    global requests, urllib3, HTTPAdapter, Retry
+    if requests is None:
+        import urllib3
+        from urllib3.util.retry import Retry
+        from requests.adapters import HTTPAdapter
+        import requests
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+def import_numpy():
+
+    # Returns False if numpy is not installed
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
 
 def usage():
     print("NetApp Active IQ CLI")
     print("Usage: " + sys.argv[0] + " [-h] [-v] [-r] [-a auth_dir] [-c] [-f] [-l] [-n lookup_name] [-i id] [ -s serial_number ] [-t]")
+    print("       [--pool_size count] [--timeout seconds] [--retries count] [--no_cache] [--max_age seconds]")
+    print("       [--bulk file] [--workers count] [--batch_size count] [--stream] [--format csv|jsonl|table] [--output file]")
+    print("       [--api_url url] [--profile] [--trace file] [--daemon] [--no_daemon]")
+    print("       [--sync] [--offline] [--over percent]")
+    print("       [--trend] [--threshold percent] [--history_days days] [--sweep] [--rate requests] [--watch seconds]")
     print("")
     print("-h  Print this message")
     print("-v  Verbose output")
@@ -30,7 +86,32 @@ def usage():
     print("-n  Name to look up")
     print("-s  Serial number to look up")
     print("-i  ID to look up")
-    print("-t  Format text output if applicable")
+    print("-t  Format text output if applicable (same as --format table)")
+    print("--pool_size  Maximum number of pooled API connections (default 16)")
+    print("--timeout    API read timeout in seconds (default 60)")
+    print("--retries    Number of retries with backoff for failed API calls (default 3)")
+    print("--no_cache   Ignore cached API responses (fresh responses are still cached)")
+    print("--max_age    Only use cached API responses younger than this many seconds")
+    print("--bulk       File with one customer ID or name per line (- for stdin) to use with -l or -f")
+    print("--workers    Number of customers to query concurrently in bulk mode (default 8)")
+    print("--batch_size Number of node serial numbers per efficiency request (default 10)")
+    print("--stream     Parse inventory and capacity responses incrementally and print rows as they arrive")
+    print("--format     Output format: csv, jsonl or table (default csv for -l, table for -f and -c)")
+    print("--output     Write output to a file instead of stdout")
+    print("--api_url    Active IQ API base URL (default $AIQ_API_URL or https://api.activeiq.netapp.com)")
+    print("--profile    Print a timing summary of API requests and processing phases to stderr")
+    print("--trace      Write a Chrome trace event JSON file of the run (implies --profile)")
+    print("--daemon     Run in the foreground as a query server on a Unix socket in the auth directory")
+    print("--no_daemon  Do not send the query to a running daemon")
+    print("--sync       Store the systems and capacity of the customers given with -i, -n or --bulk in the local inventory")
+    print("--offline    Answer -n, -l and -f queries from the local inventory without calling the API")
+    print("--over       With --offline -f, only list systems above this percent used (all customers without -i or -n)")
+    print("--trend      With -f, forecast the days until each system reaches the threshold from its stored capacity history")
+    print("--threshold  Percent used that --trend forecasts to and --watch reports crossings of (default 70)")
+    print("--history_days  Days of capacity samples kept in the local inventory for --trend (default 730)")
+    print("--rate       Maximum API requests per second, the rate and concurrency also adapt to throttling (default 0, no fixed limit)")
+    print("--sweep      With -c, report the efficiency of every cluster of the customer given with -i, or of the cluster names or serials in --bulk")
+    print("--watch      Poll the capacity of the customers given with -i, -n or --bulk every this many seconds and print only the systems that changed")
 
 class parse_args:
 
@@ -38,7 +119,7 @@ class parse_args:
 
         self.homeDir = os.environ.get('HOME')
         self.authDir = '/activeiq'
-        self.arglist = []
+        self.arglist = ['pool_size=', 'timeout=', 'retries=', 'no_cache', 'max_age=', 'bulk=', 'workers=', 'batch_size=', 'stream', 'format=', 'output=', 'api_url=', 'profile', 'trace=', 'daemon', 'no_daemon', 'sync', 'offline', 'over=', 'trend', 'threshold=', 'history_days=', 'sweep', 'rate=', 'watch=']
         self.authPath = self.homeDir + self.authDir
         self.id = None
         self.serialNumber = None
@@ -50,10 +131,41 @@ class parse_args:
         self.verboseFlag = False
         self.textFormatFlag = False
         self.diskThreshold = 70
+        self.historyDays = 730
+        self.poolSize = 16
+        self.connectTimeout = 10
+        self.readTimeout = 60
+        self.retryCount = 3
+        self.requestRate = 0
+        self.throttleRetries = 10
+        # Set by options of the HTTP session, which a daemon shares between its clients
+        self.sessionFlag = False
+        self.noCacheFlag = False
+        self.maxAge = None
+        self.cacheSize = 256 * 1024 * 1024
+        self.bulkFile = None
+        self.bulkWorkers = 8
+        self.efficiencyBatchSize = 10
+        self.streamFlag = False
+        self.outputFormat = None
+        self.outputFile = None
+        self.apiUrl = os.environ.get('AIQ_API_URL', 'https://api.activeiq.netapp.com')
+        self.profileFlag = False
+        self.traceFile = None
+        self.daemonFlag = False
+        self.noDaemonFlag = False
+        self.syncFlag = False
+        self.offlineFlag = False
+        self.overPercent = None
+        self.trendFlag = False
+        self.sweepFlag = False
+        self.watchInterval = None
         self.argCount = 0
 
-    def parse(self):
-        options, remainder = getopt.getopt(sys.argv[1:], 'hvrtfcla:n:i:s:', self.arglist)
+    def parse(self, argv=None):
+        if argv is None:
+            argv = sys.argv[1:]
+        options, remainder = getopt.getopt(argv, 'hvrtfcla:n:i:s:', self.arglist)
 
         self.argCount = len(options)
         for opt, arg in options:
@@ -87,6 +199,65 @@ class parse_args:
                 self.verboseFlag = True
             elif opt in ('-t', '--text_format'):
                 self.textFormatFlag = True
+                self.outputFormat = 'table'
+            elif opt == '--pool_size':
+                self.poolSize = int(arg)
+                self.sessionFlag = True
+            elif opt == '--timeout':
+                self.readTimeout = float(arg)
+                self.sessionFlag = True
+            elif opt == '--retries':
+                self.retryCount = int(arg)
+                self.sessionFlag = True
+            elif opt == '--no_cache':
+                self.noCacheFlag = True
+            elif opt == '--max_age':
+                self.maxAge = float(arg)
+            elif opt == '--bulk':
+                self.bulkFile = arg
+            elif opt == '--workers':
+                self.bulkWorkers = int(arg)
+            elif opt == '--batch_size':
+                self.efficiencyBatchSize = int(arg)
+            elif opt == '--stream':
+                self.streamFlag = True
+            elif opt == '--format':
+                if arg not in ('csv', 'jsonl', 'table'):
+                    print("Unknown output format %s: use csv, jsonl or table" % arg)
+                    sys.exit(1)
+                self.outputFormat = arg
+            elif opt == '--output':
+                self.outputFile = arg
+            elif opt == '--api_url':
+                self.apiUrl = arg.rstrip('/')
+            elif opt == '--profile':
+                self.profileFlag = True
+            elif opt == '--trace':
+                self.profileFlag = True
+                self.traceFile = arg
+            elif opt == '--daemon':
+                self.daemonFlag = True
+            elif opt == '--no_daemon':
+                self.noDaemonFlag = True
+            elif opt == '--sync':
+                self.syncFlag = True
+            elif opt == '--offline':
+                self.offlineFlag = True
+            elif opt == '--over':
+                self.overPercent = float(arg)
+            elif opt == '--trend':
+                self.trendFlag = True
+            elif opt == '--sweep':
+                self.sweepFlag = True
+            elif opt == '--rate':
+                self.requestRate = float(arg)
+                self.sessionFlag = True
+            elif opt == '--threshold':
+                self.diskThreshold = float(arg)
+            elif opt == '--history_days':
+                self.historyDays = int(arg)
+            elif opt == '--watch':
+                self.watchInterval = float(arg)
             elif opt in ('-h', '--help'):
                 usage()
                 sys.exit(0)
@@ -94,6 +265,25 @@ class parse_args:
                 usage()
                 sys.exit(1)
 
+class activeiq_error(Exception):
+    # Base class of the errors raised by the client instead of exiting
+    pass
+
+class api_error(activeiq_error):
+    # The API answered with an error message
+    pass
+
+class not_found_error(activeiq_error):
+    pass
+
+class ambiguous_error(activeiq_error):
+    # A name matched more than one customer
+    pass
+
+class token_error(activeiq_error):
+    # No refresh token, or the API refused to issue an access token
+    pass
+
 class auth_token:
 
     def __init__(self, argclass):
@@ -101,9 +291,14 @@ class auth_token:
         self.argset = argclass
         self.refreshTokenFile = self.argset.authPath + '/RefreshToken.txt'
         self.accessTokenFile = self.argset.authPath + '/AccessToken.txt'
+        self.lockFile = self.argset.authPath + '/.token.lock'
         self.refreshToken = ''
         self.accessToken = ''
         self.verboseFlag = self.argset.verboseFlag
+        self.expiryMargin = 300
+        self.transport = None
+        self.tracer = None
+        self.threadLock = threading.Lock()
 
     def makeAuthPath(self):
         if (not os.path.exists(self.refreshTokenFile)):
@@ -126,33 +321,79 @@ class auth_token:
 
         refreshTokenFd.close()
 
-        url = 'https://api.activeiq.netapp.com/v1/tokens/accessToken'
+        url = self.argset.apiUrl + '/v1/tokens/accessToken'
         data = '''{ "refresh_token": "''' + self.refreshToken + '''" }'''
 
-        response = requests.post(url, data=data, verify=False)
+        response = self.transport.post(url, data=data, name='genToken')
         json_data = json.loads(response.text)
 
         for key in json_data:
             if key == "error":
-                print("Generate Access Token Error: " + json_data[key])
-                sys.exit(1)
+                raise token_error("Generate Access Token Error: " + json_data[key])
             if key == "access_token":
-                accessTokenFd = open(self.accessTokenFile, "w")
                 if self.verboseFlag:
                     print("Access Token:")
                     print(json_data[key])
-                accessTokenFd.write(json_data[key])
-                accessTokenFd.close()
+                self.writeTokenFile(self.accessTokenFile, json_data[key])
             if key == "refresh_token":
-                refreshTokenFd = open(self.refreshTokenFile, "w")
                 if self.verboseFlag:
                     print("Refresh Token:")
                     print(json_data[key])
-                refreshTokenFd.write(json_data[key])
-                refreshTokenFd.close()
+                self.writeTokenFile(self.refreshTokenFile, json_data[key])
 
         self.loadToken()
 
+    def writeTokenFile(self, fileName, token):
+        # Write then rename so a concurrent reader never sees a partial token
+        tokenFd = open(fileName + '.tmp', "w")
+        tokenFd.write(token)
+        tokenFd.close()
+        os.replace(fileName + '.tmp', fileName)
+
+    @contextmanager
+    def fileLock(self):
+        lockFd = open(self.lockFile, "w")
+        try:
+            if fcntl:
+                fcntl.flock(lockFd, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lockFd, fcntl.LOCK_UN)
+            lockFd.close()
+
+    def tokenExpiry(self, token):
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+            return float(claims['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return 0.0
+
+    def tokenValid(self):
+        return self.tokenExpiry(self.accessToken) - self.expiryMargin > time.time()
+
+    def getToken(self):
+        with self.tracer.span('getToken', 'auth'):
+            if not self.argset.refreshFlag and os.path.exists(self.accessTokenFile):
+                self.loadToken()
+                if self.tokenValid():
+                    if self.verboseFlag:
+                        print("Using cached access token valid until %s" % time.ctime(self.tokenExpiry(self.accessToken)))
+                    return
+            self.renewToken(force=self.argset.refreshFlag)
+
+    def renewToken(self, staleToken=None, force=False):
+        with self.tracer.span('renewToken', 'auth'), self.threadLock:
+            with self.fileLock():
+                # Another thread or process may have refreshed while we waited for the lock
+                if not force and os.path.exists(self.accessTokenFile):
+                    self.loadToken()
+                    if self.accessToken != staleToken and self.tokenValid():
+                        return
+                self.genToken()
+
     def loadToken(self):
         accessTokenFd = open(self.accessTokenFile, "r")
 
@@ -161,105 +402,1814 @@ class auth_token:
 
         accessTokenFd.close()
 
-class activeiq:
+class trace_recorder:
+
+    # Records spans and API requests with their thread for the --profile summary and Chrome trace output
+
+    def __init__(self, argclass):
+
+        self.enabled = argclass.profileFlag
+        self.events = []
+        self.eventLock = threading.Lock()
+        self.origin = time.time()
+
+    def record(self, name, category, start, end, args):
+
+        thread = threading.current_thread()
+        with self.eventLock:
+            self.events.append({'name': name, 'cat': category, 'start': start, 'end': end,
+                                'tid': thread.ident, 'thread': thread.name, 'args': args})
+
+    @contextmanager
+    def span(self, name, category='phase', **args):
+
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.time(), args)
+
+    def request(self, name, method, start, response=None, stream=False):
+
+        if not self.enabled:
+            return
+        args = {'method': method, 'status': 'error', 'bytes': 0, 'retries': 0}
+        if response is not None:
+            args['status'] = response.status_code
+            if stream:
+                args['bytes'] = int(response.headers.get('Content-Length', 0))
+            else:
+                args['bytes'] = len(response.content)
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None:
+                args['retries'] = len(retries.history)
+        self.record(name, 'request', start, time.time(), args)
+
+    def summary(self, stream):
+
+        totals = {}
+        order = []
+        for event in self.events:
+            key = (event['cat'], event['name'])
+            if key not in totals:
+                totals[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'retries': 0, 'status': {}}
+                order.append(key)
+            elapsed = event['end'] - event['start']
+            entry = totals[key]
+            entry['count'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            if event['cat'] == 'request':
+                entry['bytes'] += event['args']['bytes']
+                entry['retries'] += event['args']['retries']
+                status = str(event['args']['status'])
+                entry['status'][status] = entry['status'].get(status, 0) + 1
+
+        stream.write("Profile: %.3f s wall time, %d threads\n" % (time.time() - self.origin,
+                                                               len(set(event['tid'] for event in self.events))))
+        stream.write("%s %s %s %s %s %s %s %s %s\n" % ('Name'.ljust(22), 'Type'.ljust(9), 'Count'.ljust(6),
+                                                      'Total s'.ljust(9), 'Mean s'.ljust(9), 'Max s'.ljust(9),
+                                                      'Bytes'.ljust(12), 'Retries'.ljust(8), 'Status'))
+        for key in order:
+            entry = totals[key]
+            status = ' '.join('%s:%d' % (code, entry['status'][code]) for code in sorted(entry['status']))
+            stream.write("%s %s %s %s %s %s %s %s %s\n" % (key[1].ljust(22), key[0].ljust(9), str(entry['count']).ljust(6),
+                                                          ("%.3f" % entry['total']).ljust(9),
+                                                          ("%.3f" % (entry['total'] / entry['count'])).ljust(9),
+                                                          ("%.3f" % entry['max']).ljust(9),
+                                                          (str(entry['bytes']) if key[0] == 'request' else '-').ljust(12),
+                                                          (str(entry['retries']) if key[0] == 'request' else '-').ljust(8),
+                                                          status or '-'))
+        stream.flush()
+
+    def writeChromeTrace(self, fileName):
+
+        pid = os.getpid()
+        trace_events = []
+        threads = {}
+        for event in self.events:
+            threads[event['tid']] = event['thread']
+            trace_events.append({'name': event['name'], 'cat': event['cat'], 'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                                 'ts': int((event['start'] - self.origin) * 1000000),
+                                 'dur': int((event['end'] - event['start']) * 1000000),
+                                 'args': event['args']})
+        for tid in threads:
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': threads[tid]}})
+
+        traceFd = open(fileName, "w")
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, traceFd)
+        traceFd.close()
+
+class rate_scheduler:
+
+    # Admits every API request: a token bucket limits the request rate and an AIMD window limits the
+    # requests in flight. Throttled responses halve both and pause all requests for Retry-After, and
+    # healthy responses grow them again additively.
+
+    def __init__(self, argclass):
+
+        self.argset = argclass
+        self.maxLimit = float(self.argset.poolSize)
+        self.limit = self.maxLimit
+        self.maxRate = self.argset.requestRate or None
+        self.rate = self.maxRate
+        self.minRate = 0.5
+        self.tokens = 1.0
+        self.refilled = time.time()
+        self.increaseStep = 5.0
+        self.pauseUntil = 0.0
+        self.decreased = 0.0
+        self.inFlight = 0
+        self.started = collections.deque()
+        self.throttleCount = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+
+        # Returns the time the request was admitted, to be passed back to release()
+        with self.condition:
+            while True:
+                now = time.time()
+                if now < self.pauseUntil:
+                    self.condition.wait(self.pauseUntil - now)
+                    continue
+                if self.inFlight >= int(self.limit):
+                    self.condition.wait()
+                    continue
+                if self.rate is not None:
+                    # A bucket of one token paces requests evenly instead of letting a second's worth through at once
+                    self.tokens = min(1.0, self.tokens + (now - self.refilled) * self.rate)
+                    self.refilled = now
+                    if self.tokens < 1.0:
+                        self.condition.wait((1.0 - self.tokens) / self.rate)
+                        continue
+                    self.tokens -= 1.0
+                self.inFlight += 1
+                self.started.append(now)
+                while self.started and self.started[0] < now - 1.0:
+                    self.started.popleft()
+                return now
+
+    def release(self, started, response=None):
+
+        with self.condition:
+            self.inFlight -= 1
+            if response is not None and response.status_code in (429, 503):
+                self.throttle(started, self.retryAfter(response))
+            elif response is not None:
+                # About one more request in flight per window of successes, and increaseStep more per second per second
+                self.limit = min(self.maxLimit, self.limit + 1.0 / self.limit)
+                if self.rate is not None and (self.maxRate is None or self.rate < self.maxRate):
+                    self.rate = self.rate + self.increaseStep / self.rate
+                    if self.maxRate is not None:
+                        self.rate = min(self.rate, self.maxRate)
+            self.condition.notify_all()
+
+    def throttle(self, started, delay):
+
+        # Requests sent before the last decrease were throttled at the old rate, so they only extend the pause.
+        # Without a fixed rate, the rate that was throttled is measured from the requests started in the last second
+        self.throttleCount += 1
+        self.pauseUntil = max(self.pauseUntil, time.time() + delay)
+        if started < self.decreased:
+            return
+        self.decreased = time.time()
+        self.limit = max(1.0, self.limit / 2)
+        if self.rate is None:
+            while self.started and self.started[0] < time.time() - 1.0:
+                self.started.popleft()
+            self.rate = float(len(self.started))
+        self.rate = max(self.minRate, self.rate / 2)
+        self.tokens = 0.0
+
+    def retryAfter(self, response):
+
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return 1.0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        import email.utils
+        try:
+            return max(0.0, time.mktime(email.utils.parsedate(value)) - time.mktime(time.gmtime()))
+        except (TypeError, ValueError, OverflowError):
+            return 1.0
+
+    def report(self):
+
+        if self.throttleCount > 0:
+            print("Throttled responses: %d Concurrency: %d Rate: %.1f/s" % (self.throttleCount, int(self.limit), self.rate))
+
+class api_session:
+
+    def __init__(self, argclass, tracer):
+
+        self.argset = argclass
+        self.tracer = tracer
+        self.verboseFlag = self.argset.verboseFlag
+        self.timeout = (self.argset.connectTimeout, self.argset.readTimeout)
+        self.requestCount = 0
+        self.countLock = threading.Lock()
+        self.scheduler = rate_scheduler(self.argset)
+        self.session = None
+        self.adapter = None
+
+    def connect(self):
+
+        # The session is set up before the first request rather than at start-up
+        with self.countLock:
+            if self.session is not None:
+                return
+            import_http()
+
+            # Throttled responses (429 and 503) are retried by send() through the scheduler
+            retries = Retry(total=self.argset.retryCount, backoff_factor=0.5,
+                            status_forcelist=(500, 502, 504), respect_retry_after_header=False)
+            # Block rather than open throwaway connections when the thread fan-out exceeds the pool
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.argset.poolSize,
+                                  pool_block=True, max_retries=retries)
+
+            session = requests.Session()
+            session.verify = False
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.adapter = adapter
+            self.session = session
+
+    def send(self, method, url, name, stream=False, **kwargs):
+
+        self.connect()
+        attempt = 0
+        while True:
+            with self.countLock:
+                self.requestCount += 1
+            start = self.scheduler.acquire()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, stream=stream, **kwargs)
+            except requests.exceptions.RequestException:
+                self.scheduler.release(start)
+                self.tracer.request(name, method, start)
+                raise
+            self.scheduler.release(start, response)
+            self.tracer.request(name, method, start, response, stream=stream)
+            if response.status_code not in (429, 503) or attempt >= self.argset.throttleRetries:
+                return response
+            response.close()
+            attempt += 1
+
+    def get(self, url, headers=None, stream=False, name='GET'):
+
+        return self.send('GET', url, name, stream=stream, headers=headers)
+
+    def post(self, url, data=None, headers=None, name='POST'):
+
+        return self.send('POST', url, name, data=data, headers=headers)
+
+    def close(self):
+
+        with self.countLock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+    def handshakeCount(self):
+
+        count = 0
+        if self.adapter is None:
+            return count
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            count += pools[key].num_connections
+        return count
+
+    def report(self):
+
+        print("API requests: %d Connections opened: %d" % (self.requestCount, self.handshakeCount()))
+        self.scheduler.report()
+
+class call_graph:
+
+    # Runs each call on the pool as soon as the futures among its arguments have finished, so independent
+    # requests overlap and every request waits only for its own inputs. A failed input fails the call with it
+
+    def __init__(self, workers):
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+
+    def call(self, function, *args):
+
+        future = Future()
+        inputs = [arg for arg in args if isinstance(arg, Future)]
+        pending = [len(inputs)]
+        pendingLock = threading.Lock()
+
+        def run():
+            try:
+                future.set_result(function(*[arg.result() if isinstance(arg, Future) else arg for arg in args]))
+            except Exception as exception:
+                future.set_exception(exception)
+
+        def ready(done):
+            with pendingLock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            self.executor.submit(run)
+
+        if len(inputs) == 0:
+            self.executor.submit(run)
+        for arg in inputs:
+            arg.add_done_callback(ready)
+        return future
+
+class response_cache:
+
+    def __init__(self, argclass):
+
+        self.argset = argclass
+        self.verboseFlag = self.argset.verboseFlag
+        self.cacheFile = self.argset.authPath + '/ResponseCache.db'
+        self.maxBytes = self.argset.cacheSize
+        self.maxAge = self.argset.maxAge
+        self.readFlag = not self.argset.noCacheFlag
+        self.apiUrl = self.argset.apiUrl
+        # Cache hits are reported from whichever thread made the request, so they go to a stream of the run
+        self.messageStream = sys.stdout
+        # Seconds a response is fresh, then seconds it may still be served while it is refreshed
+        self.ttl = {
+            'customerLookup': (7 * 86400, 7 * 86400),
+            'clusterSearch': (7 * 86400, 7 * 86400),
+            'systemList': (6 * 3600, 18 * 3600),
+            'capacityDetail': (6 * 3600, 18 * 3600),
+            'getClusterSummary': (3600, 6 * 3600),
+            'getClusterResolver': (3600, 6 * 3600),
+            'nodeEfficiency': (3600, 6 * 3600),
+        }
+        self.dbLock = threading.Lock()
+        self.db = sqlite3.connect(self.cacheFile, timeout=30, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                           endpoint TEXT NOT NULL,
+                           key TEXT NOT NULL,
+                           body BLOB NOT NULL,
+                           size INTEGER NOT NULL,
+                           stored REAL NOT NULL,
+                           accessed REAL NOT NULL,
+                           PRIMARY KEY (endpoint, key))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.commit()
+        self.memory = OrderedDict()
+        self.memoryEntries = 0
+
+    def close(self):
+
+        with self.dbLock:
+            self.db.close()
+
+    def view(self, argclass, messageStream=None):
+        # A copy with another run's read options and output that shares the database and memory layer
+        cache = copy.copy(self)
+        if messageStream is not None:
+            cache.messageStream = messageStream
+        cache.argset = argclass
+        cache.verboseFlag = argclass.verboseFlag
+        cache.maxAge = argclass.maxAge
+        cache.readFlag = not argclass.noCacheFlag
+        cache.apiUrl = argclass.apiUrl
+        return cache
+
+    def storeKey(self, key):
+        # Responses are stored per API URL so a test or mock server's responses are never served for another
+        return self.apiUrl + ' ' + key
+
+    def freshness(self, endpoint, stored):
+        age = time.time() - stored
+        fresh, stale = self.ttl.get(endpoint, (0, 0))
+        if self.maxAge is not None:
+            fresh, stale = self.maxAge, 0
+        if age <= fresh:
+            return 'fresh'
+        elif age <= fresh + stale:
+            return 'stale'
+        return None
+
+    def report(self, state, endpoint, key, stored):
+        if self.verboseFlag:
+            self.messageStream.write("Cache %s: %s %s (age %ds)\n" % (state, endpoint, key, time.time() - stored))
+
+    def get(self, endpoint, key):
+        # Returns (body, state) where state is fresh, stale or None on a miss
+        if not self.readFlag:
+            return None, None
+        if self.memoryEntries > 0:
+            with self.dbLock:
+                entry = self.memory.get((endpoint, self.storeKey(key)))
+                if entry is not None:
+                    self.memory.move_to_end((endpoint, self.storeKey(key)))
+            if entry is not None:
+                state = self.freshness(endpoint, entry[1])
+                if state is not None:
+                    self.report(state, endpoint, key, entry[1])
+                    return entry[0], state
+
+        row = self.getRow(endpoint, key)
+        if row is None:
+            return None, None
+        state = self.freshness(endpoint, row[1])
+        if state is None:
+            return None, None
+        self.report(state, endpoint, key, row[1])
+        body = zlib.decompress(row[0]).decode('utf-8')
+        self.remember(endpoint, key, body, row[1])
+        return body, state
+
+    def getCompressed(self, endpoint, key):
+        if not self.readFlag:
+            return None, None
+        row = self.getRow(endpoint, key)
+        if row is None:
+            return None, None
+        state = self.freshness(endpoint, row[1])
+        if state is None:
+            return None, None
+        self.report(state, endpoint, key, row[1])
+        return row[0], state
+
+    def lastKnown(self, endpoint, key):
+        # The stored body at any age, only used to guess ahead of a request that is made anyway
+        row = self.getRow(endpoint, key)
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def getRow(self, endpoint, key):
+        key = self.storeKey(key)
+        with self.dbLock:
+            row = self.db.execute('SELECT body, stored FROM responses WHERE endpoint = ? AND key = ?',
+                                  (endpoint, key)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE endpoint = ? AND key = ?',
+                            (time.time(), endpoint, key))
+            self.db.commit()
+        return row
+
+    def remember(self, endpoint, key, body, stored):
+        # Decoded bodies kept in memory by long running processes, most recently used last
+        if self.memoryEntries == 0:
+            return
+        key = self.storeKey(key)
+        with self.dbLock:
+            self.memory[(endpoint, key)] = (body, stored)
+            self.memory.move_to_end((endpoint, key))
+            while len(self.memory) > self.memoryEntries:
+                self.memory.popitem(last=False)
+
+    def decompressChunks(self, data, chunkSize=65536):
+        decompressor = zlib.decompressobj()
+        for offset in range(0, len(data), chunkSize):
+            yield decompressor.decompress(data[offset:offset + chunkSize])
+        yield decompressor.flush()
+
+    def put(self, endpoint, key, body):
+        self.putCompressed(endpoint, key, zlib.compress(body.encode('utf-8')))
+        self.remember(endpoint, key, body, time.time())
+
+    def putCompressed(self, endpoint, key, data):
+        key = self.storeKey(key)
+        now = time.time()
+        with self.dbLock:
+            self.memory.pop((endpoint, key), None)
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (endpoint, key, data, len(data), now, now))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.maxBytes:
+            return
+        for endpoint, key, size in self.db.execute('SELECT endpoint, key, size FROM responses ORDER BY accessed').fetchall():
+            if total <= self.maxBytes:
+                break
+            self.db.execute('DELETE FROM responses WHERE endpoint = ? AND key = ?', (endpoint, key))
+            total -= size
+
+class inventory_store:
+
+    # Local copy of systems and their latest capacity keyed by serial number, refreshed with --sync
+
+    def __init__(self, argclass):
+
+        self.argset = argclass
+        self.storeFile = self.argset.authPath + '/Inventory.db'
+        self.dbLock = threading.Lock()
+        self.db = sqlite3.connect(self.storeFile, timeout=30, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS customers (
+                           customer_id TEXT PRIMARY KEY,
+                           name TEXT,
+                           synced REAL NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS systems (
+                           serial_number TEXT PRIMARY KEY,
+                           customer_id TEXT NOT NULL,
+                           hostname TEXT,
+                           platform_type TEXT,
+                           system_id TEXT,
+                           model TEXT,
+                           operating_mode TEXT,
+                           version TEXT,
+                           content_hash TEXT NOT NULL,
+                           updated REAL NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS capacity (
+                           serial_number TEXT PRIMARY KEY,
+                           customer_id TEXT NOT NULL,
+                           hostname TEXT,
+                           used_capacity_GB,
+                           allocated_capacity_GB,
+                           percent_capacity REAL,
+                           category TEXT,
+                           content_hash TEXT NOT NULL,
+                           updated REAL NOT NULL)''')
+        # One row per system and day, clustered by system so a forecast reads each system's samples in day order
+        self.db.execute('''CREATE TABLE IF NOT EXISTS capacity_samples (
+                           serial_number TEXT NOT NULL,
+                           day INTEGER NOT NULL,
+                           used_capacity_GB REAL NOT NULL,
+                           allocated_capacity_GB REAL NOT NULL,
+                           PRIMARY KEY (serial_number, day)) WITHOUT ROWID''')
+        self.migrateHistory()
+        self.db.execute('CREATE INDEX IF NOT EXISTS systems_customer ON systems (customer_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS capacity_customer ON capacity (customer_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS capacity_percent ON capacity (percent_capacity)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS customers_name ON customers (name COLLATE NOCASE)')
+        self.db.commit()
+
+    def migrateHistory(self):
+
+        # Earlier versions packed all samples of a system into one BLOB of (day, used GB, allocated GB) doubles
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'capacity_history'").fetchone() is None:
+            return
+        for serial, packed in self.db.execute('SELECT serial_number, samples FROM capacity_history').fetchall():
+            samples = array.array('d')
+            samples.frombytes(packed)
+            self.db.executemany('INSERT OR REPLACE INTO capacity_samples VALUES (?, ?, ?, ?)',
+                                [(serial, int(samples[x]), samples[x + 1], samples[x + 2]) for x in range(0, len(samples), 3)])
+        self.db.execute('DROP TABLE capacity_history')
+
+    def close(self):
+
+        with self.dbLock:
+            self.db.close()
+
+    def contentHash(self, values):
+        return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+    def replaceRows(self, table, customer_id, rows, columns):
+
+        # Upsert rows whose content hash changed and delete the customer's rows that are no longer reported
+        now = time.time()
+        records = [row + [customer_id, self.contentHash(row), now] for row in rows]
+        columns = columns + ['customer_id', 'content_hash', 'updated']
+        assignments = ', '.join('%s = excluded.%s' % (column, column) for column in columns[1:])
+
+        before = self.db.total_changes
+        self.db.executemany('INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (serial_number) DO UPDATE SET %s '
+                            'WHERE %s.content_hash != excluded.content_hash OR %s.customer_id != excluded.customer_id'
+                            % (table, ', '.join(columns), ', '.join(['?'] * len(columns)), assignments, table, table),
+                            records)
+        changed = self.db.total_changes - before
+
+        current = set(row[0] for row in rows)
+        removed = [(serial,) for (serial,) in self.db.execute('SELECT serial_number FROM %s WHERE customer_id = ?' % table,
+                                                              (customer_id,)).fetchall() if serial not in current]
+        self.db.executemany('DELETE FROM %s WHERE serial_number = ?' % table, removed)
+        return changed, len(removed)
+
+    def appendHistory(self, capacity, day):
+
+        # One sample per system per day, a later run on the same day replaces it. Samples older than the
+        # retention window are dropped, each a range of the system's primary key
+        records = []
+        for serial, hostname, used, allocated, percent, category in capacity:
+            try:
+                records.append((serial, day, float(used), float(allocated)))
+            except (TypeError, ValueError):
+                continue
+        self.db.executemany('INSERT OR REPLACE INTO capacity_samples VALUES (?, ?, ?, ?)', records)
+        oldest = day - self.argset.historyDays
+        self.db.executemany('DELETE FROM capacity_samples WHERE serial_number = ? AND day <= ?',
+                            [(record[0], oldest) for record in records])
+
+    def sync(self, customer_id, system_list, capacity_index, name=None):
+
+        # Without a system list only the capacity records and their history are updated
+        systems = []
+        if system_list is not None:
+            for result in system_list.get('results', []):
+                systems.append([result.serial_number, result.hostname, result.platform_type, result.system_id,
+                                result.model, result.operating_mode, result.version])
+        capacity = []
+        for serial, system in capacity_index.items():
+            capacity.append([serial, system.hostname, system.used_capacity_GB, system.allocated_capacity_GB,
+                             system.percent_capacity, system.category])
+
+        with self.dbLock:
+            self.db.execute('INSERT INTO customers VALUES (?, ?, ?) ON CONFLICT (customer_id) DO UPDATE SET '
+                            'name = COALESCE(excluded.name, customers.name), synced = excluded.synced',
+                            (customer_id, name, time.time()))
+            system_changes = (0, 0)
+            if system_list is not None:
+                system_changes = self.replaceRows('systems', customer_id, systems,
+                                                  ['serial_number', 'hostname', 'platform_type', 'system_id', 'model', 'operating_mode', 'version'])
+            capacity_changes = self.replaceRows('capacity', customer_id, capacity,
+                                                ['serial_number', 'hostname', 'used_capacity_GB', 'allocated_capacity_GB', 'percent_capacity', 'category'])
+            self.appendHistory(capacity, int(time.time() // 86400))
+            self.db.commit()
+        return system_changes, capacity_changes
+
+    def findCustomers(self, name):
+        with self.dbLock:
+            return self.db.execute('SELECT c.customer_id, c.name, COUNT(s.serial_number) FROM customers c '
+                                   'LEFT JOIN systems s ON s.customer_id = c.customer_id '
+                                   'WHERE c.name LIKE ? OR c.customer_id = ? GROUP BY c.customer_id ORDER BY c.name',
+                                   ('%' + name + '%', name)).fetchall()
+
+    def inventoryRows(self, customer_id):
+        with self.dbLock:
+            return self.db.execute('SELECT s.hostname, s.platform_type, s.system_id, s.serial_number, s.model, s.operating_mode, '
+                                   's.version, c.used_capacity_GB, c.percent_capacity, c.allocated_capacity_GB FROM systems s '
+                                   'LEFT JOIN capacity c ON c.serial_number = s.serial_number '
+                                   'WHERE s.customer_id = ? ORDER BY s.hostname', (customer_id,)).fetchall()
+
+    def forecastRows(self, customer_id=None, over=None):
+        query = 'SELECT customer_id, hostname, percent_capacity, category FROM capacity WHERE 1 = 1'
+        params = []
+        if customer_id is not None:
+            query += ' AND customer_id = ?'
+            params.append(customer_id)
+        if over is not None:
+            query += ' AND percent_capacity > ?'
+            params.append(over)
+        with self.dbLock:
+            return self.db.execute(query + ' ORDER BY percent_capacity', params).fetchall()
+
+    def history(self, customer_id=None, over=None):
+
+        # Returns the systems with their sample counts, then all their samples as one (day, used, allocated) array
+        # grouped by system in the same order and sorted by day
+        where = ''
+        params = []
+        if customer_id is not None:
+            where += ' AND c.customer_id = ?'
+            params.append(customer_id)
+        if over is not None:
+            where += ' AND c.percent_capacity > ?'
+            params.append(over)
+        with self.dbLock:
+            systems = self.db.execute('SELECT c.customer_id, c.hostname, c.percent_capacity, COUNT(*) FROM capacity c '
+                                      'JOIN capacity_samples s ON s.serial_number = c.serial_number WHERE 1 = 1' + where +
+                                      ' GROUP BY c.serial_number ORDER BY c.serial_number', params).fetchall()
+            # Read in primary key order, so no sort is needed
+            rows = self.db.execute('SELECT day, used_capacity_GB, allocated_capacity_GB FROM capacity_samples WHERE serial_number IN '
+                                   '(SELECT c.serial_number FROM capacity c WHERE 1 = 1' + where + ') ORDER BY serial_number, day',
+                                   params)
+            count = sum(system[3] for system in systems)
+            samples = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.float64, count=count * 3)
+        return systems, samples.reshape(-1, 3)
+
+def growth_forecast(counts, day, used, allocated, threshold, today=None):
+
+    # Least squares growth per system over all samples at once; samples are grouped by system and sorted by day
+    import_numpy()
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    group = numpy.repeat(numpy.arange(len(counts)), counts)
+    last = numpy.cumsum(counts) - 1
+    if today is None:
+        today = time.time() / 86400
+
+    size = numpy.maximum(counts, 1)
+    mean_day = numpy.bincount(group, weights=day, minlength=len(counts)) / size
+    mean_used = numpy.bincount(group, weights=used, minlength=len(counts)) / size
+    day_offset = day - mean_day[group]
+    variance = numpy.bincount(group, weights=day_offset * day_offset, minlength=len(counts))
+    covariance = numpy.bincount(group, weights=day_offset * (used - mean_used[group]), minlength=len(counts))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        growth = numpy.where(variance > 0, covariance / variance, numpy.nan)
+
+        # Days from today until the system crosses the threshold, growing at the fitted rate from its last sample;
+        # NaN when the system is not growing
+        remaining = allocated[last] * threshold / 100.0 - used[last]
+        days = numpy.where(growth > 0, remaining / growth - (today - day[last]), numpy.nan)
+        days = numpy.where(remaining <= 0, 0.0, numpy.maximum(days, 0.0))
+    return growth, days
+
+def trend_rows(store, threshold, customer_id=None, over=None):
+
+    # Rows of customer, hostname, percent, growth per day and days to threshold, soonest first
+    import_numpy()
+    systems, samples = store.history(customer_id, over)
+    if len(systems) == 0:
+        return []
+    growth, days = growth_forecast([system[3] for system in systems], samples[:, 0], samples[:, 1], samples[:, 2], threshold)
+    rows = []
+    for x in numpy.argsort(days, kind='stable'):
+        rows.append([systems[x][0], systems[x][1], systems[x][2],
+                     None if numpy.isnan(growth[x]) else round(float(growth[x]), 2),
+                     None if numpy.isnan(days[x]) else int(days[x])])
+    return rows
+
+def full_status(category):
+
+    if category == "current_90":
+        return "Currently Full"
+    elif category == "1_month_90":
+        return "1 Month To Full"
+    elif category == "3_months_90":
+        return "3 Months To Full"
+    elif category == "6_months_90":
+        return "6 Months To Full"
+    else:
+        return "More Than 6 Months To Full"
+
+def decode_chunks(chunks):
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+class json_stream:
+
+    # Incremental reader for a JSON object that yields the elements of the arrays found at a key path
+    # ('*' matches any key) without holding the whole document. Other top level values are kept in values.
+
+    def __init__(self, chunks):
+
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.values = {}
+
+    def fill(self):
+
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        if self.pos > 65536:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError("Expected one of '%s' in JSON stream but found '%s'" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number may go on in the next chunk ('12' of '12.5', '1e' of '1e+5'), so only accept it once a
+                # character that cannot continue it follows
+                if self.eof or not (isinstance(value, (int, float)) and not isinstance(value, bool)
+                                    and (end == len(self.buffer) or self.buffer[end] in '.eE+-0123456789')):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self, path):
+
+        self.expect('{')
+        for item in self.objectItems(path, []):
+            yield item
+        # Drain the source so wrapped generators, like the cache writer, run to completion
+        for chunk in self.chunks:
+            pass
+
+    def objectItems(self, path, prefix):
+
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if (path[0] == '*' or path[0] == key) and self.peek() == ('[' if len(path) == 1 else '{'):
+                self.pos += 1
+                if len(path) == 1:
+                    for item in self.arrayItems(prefix + [key]):
+                        yield item
+                else:
+                    for item in self.objectItems(path[1:], prefix + [key]):
+                        yield item
+            else:
+                value = self.value()
+                if len(prefix) == 0:
+                    self.values[key] = value
+            if self.expect(',}') == '}':
+                return
+
+    def arrayItems(self, keys):
+
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield keys, self.value()
+            if self.expect(',]') == ']':
+                return
+
+# Output columns as (label, JSON key, table width)
+INVENTORY_COLUMNS = [('Hostname', 'hostname', 20), ('Platform', 'platform_type', 20),
+                     ('System ID', 'system_id', 40), ('Serial', 'serial_number', 20),
+                     ('Model', 'model', 15), ('Mode', 'operating_mode', 15),
+                     ('Version', 'version', 10), ('Used', 'used_capacity_GB', 12),
+                     ('Percent', 'percent_capacity', 12), ('Allocated', 'allocated_capacity_GB', 12)]
+FORECAST_COLUMNS = [('Hostname', 'hostname', 25), ('Percent', 'percent_capacity', 10), ('Time To Full', 'status', 0)]
+SUMMARY_COLUMNS = [('Attribute', 'attribute', 25), ('Value', 'value', 0)]
+NODE_COLUMNS = [('Hostname', 'hostname', 25), ('Serial', 'serial_number', 20), ('Model', 'model', 10),
+                ('Efficiency', 'node_overall_efficiency_ratio_without_clone_snapshot', 0)]
+TREND_COLUMNS = [('Hostname', 'hostname', 25), ('Percent', 'percent_capacity', 10),
+                 ('Growth GB/Day', 'growth_GB_per_day', 15), ('Days To Threshold', 'days_to_threshold', 0)]
+CLUSTER_COLUMNS = [('Cluster', 'cluster_name', 25), ('Lookup', 'lookup', 20), ('Nodes', 'node_count', 6),
+                   ('Efficiency', 'average_efficiency', 0)]
+CUSTOMER_COLUMN = ('Customer', 'customer_id', 10)
+# Seconds a daemon has to take a request, and between the heartbeats it sends while the request runs
+DAEMON_ACCEPT_TIMEOUT = 2.0
+DAEMON_HEARTBEAT = 5.0
+WATCH_COLUMNS = [CUSTOMER_COLUMN, ('Hostname', 'hostname', 25), ('Percent', 'percent_capacity', 10),
+                 ('Time To Full', 'status', 28), ('Change', 'change', 0)]
+
+def shared(value):
+
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+class system_record:
+
+    # The systemList fields the commands use; slotted records take a fraction of the memory of the parsed dicts.
+    # Fields with few distinct values across a fleet are interned so every record shares one string
+
+    __slots__ = ('hostname', 'platform_type', 'system_id', 'serial_number', 'model', 'operating_mode', 'version')
+
+    def __init__(self, result):
+
+        self.hostname = result.get('hostname')
+        self.platform_type = shared(result.get('platform_type'))
+        self.system_id = result.get('system_id')
+        self.serial_number = result['serial_number']
+        self.model = shared(result.get('model'))
+        self.operating_mode = shared(result.get('operating_mode'))
+        self.version = shared(result.get('version'))
+
+class capacity_record:
+
+    __slots__ = ('hostname', 'serial_number', 'used_capacity_GB', 'percent_capacity', 'allocated_capacity_GB', 'category')
+
+    def __init__(self, system, category):
+
+        self.hostname = system.get('hostname')
+        self.serial_number = system['serial_number']
+        self.used_capacity_GB = system.get('used_capacity_GB')
+        self.percent_capacity = system.get('percent_capacity')
+        self.allocated_capacity_GB = system.get('allocated_capacity_GB')
+        self.category = shared(category)
+
+class node_record:
+
+    __slots__ = ('hostname', 'serial_number', 'model', 'efficiency')
+
+    def __init__(self, system, model):
+
+        self.hostname = system.get('hostname')
+        self.serial_number = system['serial_number']
+        self.model = shared(model)
+        self.efficiency = shared(system['node_overall_efficiency_ratio_without_clone_snapshot'])
+
+class output_writer:
+
+    # Rows are formatted into an in-memory buffer that is written to the stream in large blocks
+
+    def __init__(self, columns, stream, header=True, separator=' ', blockSize=1048576):
+
+        self.columns = columns
+        self.stream = stream
+        self.separator = separator
+        self.blockSize = blockSize
+        self.buffer = io.StringIO()
+        if header:
+            self.header()
+
+    def header(self):
+        pass
+
+    def row(self, values):
+        pass
+
+    def text(self, line):
+        self.write(line + '\n')
+
+    def write(self, text):
+        self.buffer.write(text)
+        if self.buffer.tell() >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer.tell() > 0:
+            self.stream.write(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate(0)
+        self.stream.flush()
+
+class csv_writer(output_writer):
+
+    def __init__(self, columns, stream, header=True, separator=',', blockSize=1048576):
+
+        self.writer = None
+        output_writer.__init__(self, columns, stream, header=header, separator=separator, blockSize=blockSize)
+
+    def header(self):
+        self.row([column[0].replace(' ', '') for column in self.columns])
+
+    def row(self, values):
+        if self.writer is None:
+            self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.writer.writerow(['N/A' if value is None else value for value in values])
+        if self.buffer.tell() >= self.blockSize:
+            self.flush()
+
+class jsonl_writer(output_writer):
+
+    def row(self, values):
+        self.write(json.dumps(row_dict(self.columns, values)) + '\n')
+
+class table_writer(output_writer):
+
+    def header(self):
+        self.row([column[0] for column in self.columns])
+
+    def row(self, values):
+        fields = []
+        for x in range(len(self.columns)):
+            fields.append(str('N/A' if values[x] is None else values[x]).ljust(self.columns[x][2]))
+        self.write(self.separator.join(fields) + '\n')
+
+def row_dict(columns, values):
+
+    # A row keyed by the JSON field names of its columns
+    record = {}
+    for x in range(len(columns)):
+        record[columns[x][1]] = values[x]
+    return record
+
+def make_writer(outputFormat, columns, stream, header=True, separator=' '):
+
+    if outputFormat == 'csv':
+        return csv_writer(columns, stream, header=header)
+    elif outputFormat == 'jsonl':
+        return jsonl_writer(columns, stream, header=header)
+    else:
+        return table_writer(columns, stream, header=header, separator=separator)
+
+class activeiq_client:
+
+    # The API client without any output: fetch* methods return one parsed API response, get* methods return
+    # checked results and resolve* methods return IDs. They raise activeiq_error subclasses, while transport
+    # failures raise the requests exceptions (all IOError). Only the activeiq subclass keeps command state.
+    # Create one with connect(), or async_client(connect()) to await the same methods from an asyncio event
+    # loop, and close() it to release the HTTP session and both databases.
 
     def __init__(self, auth):
 
-        auth.genToken()
+        self.tracer = trace_recorder(auth.argset)
+        self.transport = api_session(auth.argset, self.tracer)
+        auth.tracer = self.tracer
+        auth.transport = self.transport
+        auth.getToken()
         self.token = auth
-        self.authToken = self.token.accessToken
-        self.verboseFlag = self.token.verboseFlag
-        self.textFormatFlag = self.token.argset.textFormatFlag
-        self.diskThreshold = self.token.argset.diskThreshold
+        self.cache = response_cache(auth.argset)
+        self.store = None
+        # The query that owns the session and databases; forked queries only close their output
+        self.root = self
+        # Requests in flight by (endpoint, lookup, cache options), shared with the queries forked from this one
+        self.inflight = {}
+        self.inflightLock = threading.Lock()
+        self.resetState()
+        self.configure(auth.argset)
+
+    def resetState(self):
+
+        self.revalidateThreads = []
         self.customer_data = {}
-        self.customer_count = 0
         self.system_list = {}
-        self.system_count = 0
         self.capacity_detail = {}
+        self.capacity_index = {}
         self.cluster_summary_data = {}
         self.cluster_resolver = {}
-        self.cluster_id = {}
         self.node_efficiency = {}
+        self.node_latency = {}
+        self.efficiencyLock = threading.Lock()
+        self.validators = {}
         self.id = []
 
-    def customerLookup(self, lookup):
+    def configure(self, argclass):
+
+        self.verboseFlag = argclass.verboseFlag
+        self.textFormatFlag = argclass.textFormatFlag
+        self.diskThreshold = argclass.diskThreshold
+        self.trendFlag = argclass.trendFlag
+        self.efficiencyBatchSize = argclass.efficiencyBatchSize
+        self.poolSize = argclass.poolSize
+        self.streamFlag = argclass.streamFlag
+        self.apiUrl = argclass.apiUrl
+        self.outputFormat = argclass.outputFormat
+        if argclass.outputFile:
+            self.outputStream = open(argclass.outputFile, "w")
+        else:
+            self.outputStream = sys.stdout
+
+    def fork(self, argclass, messageStream=None):
+
+        # A query for another run that shares this one's token, connection pool and cache. Diagnostics
+        # printed by the threads the run starts go to messageStream, which a daemon sets to its client
+        query = copy.copy(self)
+        query.cache = self.cache.view(argclass, messageStream)
+        query.resetState()
+        query.configure(argclass)
+        return query
+
+    def close(self):
+
+        if self.outputStream is not sys.stdout:
+            self.outputStream.close()
+        if self.root is self:
+            self.transport.close()
+            self.cache.close()
+            if self.store is not None:
+                self.store.close()
+
+    def apiGet(self, url, stream=False, name='GET', headers=None):
+
+        token = self.token.accessToken
+        request_headers = dict(headers or {})
+        request_headers.update({'accept': 'application/json', 'authorizationToken': token})
+        response = self.transport.get(url, headers=request_headers, stream=stream, name=name)
+        if response.status_code == 401:
+            response.close()
+            self.token.renewToken(staleToken=token)
+            request_headers['authorizationToken'] = self.token.accessToken
+            response = self.transport.get(url, headers=request_headers, stream=stream, name=name)
+        return response
+
+    def conditionalGet(self, endpoint, lookup, url):
+
+        # Returns the response body, or None when the API answers 304 Not Modified. The ETag and Last-Modified
+        # of the previous response are sent back so an unchanged response costs no body and no parsing
+        headers = {}
+        etag, modified = self.validators.get((endpoint, lookup), (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        with self.tracer.span(endpoint, 'endpoint', lookup=lookup):
+            response = self.apiGet(url, name=endpoint, headers=headers)
+            if response.status_code == 304:
+                response.close()
+                return None
+            if response.status_code == 200:
+                self.validators[(endpoint, lookup)] = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                self.cache.put(endpoint, lookup, response.text)
+            return response.text
+
+    def cachedGet(self, endpoint, lookup, url):
+
+        # A request that is already in flight in this process is not sent again, its response is shared
+        key = (self.apiUrl, endpoint, lookup, self.cache.readFlag, self.cache.maxAge)
+        with self.inflightLock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[key] = future
+        if not owner:
+            with self.tracer.span(endpoint, 'shared', lookup=lookup):
+                return future.result()
+
+        try:
+            body = self.sendCachedGet(endpoint, lookup, url)
+            future.set_result(body)
+            return body
+        except Exception as exception:
+            future.set_exception(exception)
+            raise
+        finally:
+            with self.inflightLock:
+                del self.inflight[key]
+
+    def sendCachedGet(self, endpoint, lookup, url):
+
+        with self.tracer.span(endpoint, 'endpoint', lookup=lookup):
+            body, state = self.cache.get(endpoint, lookup)
+            if state == 'fresh':
+                return body
+            if state == 'stale':
+                runThread = threading.Thread(target=self.revalidate, args=(endpoint, lookup, url))
+                runThread.start()
+                self.revalidateThreads.append(runThread)
+                return body
+
+            response = self.apiGet(url, name=endpoint)
+            if response.status_code == 200:
+                self.cache.put(endpoint, lookup, response.text)
+            return response.text
+
+    def streamGet(self, endpoint, lookup, url):
+
+        # Text chunks of the response body, read from the cache or from the API while it is being cached
+        data, state = self.cache.getCompressed(endpoint, lookup)
+        if state == 'stale':
+            runThread = threading.Thread(target=self.revalidate, args=(endpoint, lookup, url))
+            runThread.start()
+            self.revalidateThreads.append(runThread)
+        if state is not None:
+            return decode_chunks(self.cache.decompressChunks(data))
+
+        return decode_chunks(self.cacheChunks(endpoint, lookup, self.apiGet(url, stream=True, name=endpoint)))
+
+    def cacheChunks(self, endpoint, lookup, response):
+
+        compressor = zlib.compressobj()
+        parts = []
+        for chunk in response.iter_content(chunk_size=65536):
+            parts.append(compressor.compress(chunk))
+            yield chunk
+        if response.status_code == 200:
+            parts.append(compressor.flush())
+            self.cache.putCompressed(endpoint, lookup, b''.join(parts))
+
+    def revalidate(self, endpoint, lookup, url):
+
+        with self.tracer.span(endpoint, 'revalidate', lookup=lookup):
+            for chunk in self.cacheChunks(endpoint, lookup, self.apiGet(url, stream=True, name=endpoint)):
+                pass
+
+    def waitRevalidate(self):
+
+        for runThread in self.revalidateThreads:
+            runThread.join()
+
+    def fetchCustomerSearch(self, lookup):
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
         parseparams = {'name': lookup}
-        url = 'https://api.activeiq.netapp.com/v1/search/aggregate/level/customer?' + urlencode(parseparams)
+        url = self.apiUrl + '/v1/search/aggregate/level/customer?' + urlencode(parseparams)
+
+        return json.loads(self.cachedGet('customerLookup', lookup, url))
+
+    def fetchSystemList(self, lookup):
+
+        url = self.apiUrl + '/v1/systemList/aggregate/level/customer/id/' + lookup
+
+        return self.systemRecords(json.loads(self.cachedGet('systemList', lookup, url)))
+
+    def systemRecords(self, system_list):
+
+        # Replaces the parsed results with system records so the raw dicts can be freed
+        if 'results' in system_list:
+            system_list['results'] = [system_record(result) for result in system_list['results']]
+        return system_list
+
+    def streamSystemList(self, lookup):
+
+        url = self.apiUrl + '/v1/systemList/aggregate/level/customer/id/' + lookup
+
+        return json_stream(self.streamGet('systemList', lookup, url))
+
+    def fetchCapacityDetail(self, lookup):
+
+        url = self.apiUrl + '/v2/capacity/details/level/customer/id/' + lookup
+
+        return json.loads(self.cachedGet('capacityDetail', lookup, url))
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.customer_data = json.loads(response.text)
-        self.customer_count = len(self.customer_data)
+    def fetchCapacity(self, lookup):
 
-    def systemList(self, lookup):
+        # Returns (response without the capacity tree, capacity index)
+        capacity_detail = self.fetchCapacityDetail(lookup)
+        with self.tracer.span('buildCapacityIndex'):
+            capacity_index = self.buildCapacityIndex(capacity_detail)
+        # Only the index is kept, the rest of the response is needed for its error message
+        capacity_detail.pop('capacity', None)
+        return capacity_detail, capacity_index
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
-        url = 'https://api.activeiq.netapp.com/v1/systemList/aggregate/level/customer/id/' + lookup
+    def buildCapacityIndex(self, capacity_detail):
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.system_list = json.loads(response.text)
-        self.system_count = len(self.system_list)
+        # Single pass over the capacity tree so the inventory and forecast joins are a dict lookup per system
+        capacity_index = {}
+        if "capacity" not in capacity_detail:
+            return capacity_index
+        for detail in capacity_detail['capacity']:
+            for category in capacity_detail['capacity'][detail]:
+                for system in capacity_detail['capacity'][detail][category]:
+                    if system['serial_number'] not in capacity_index:
+                        capacity_index[system['serial_number']] = capacity_record(system, category)
+        return capacity_index
 
-    def capacityDetail(self, lookup):
+    def streamCapacityIndex(self, lookup, capacity_index):
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
-        url = 'https://api.activeiq.netapp.com/v2/capacity/details/level/customer/id/' + lookup
+        # Fill capacity_index in place while the response is parsed, keeping only the fields the commands use
+        url = self.apiUrl + '/v2/capacity/details/level/customer/id/' + lookup
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.capacity_detail = json.loads(response.text)
+        with self.tracer.span('capacityDetail', 'endpoint', lookup=lookup, stream=True):
+            stream = json_stream(self.streamGet('capacityDetail', lookup, url))
+            for keys, system in stream.items(['capacity', '*', '*']):
+                if system['serial_number'] not in capacity_index:
+                    capacity_index[system['serial_number']] = capacity_record(system, keys[2])
+        self.capacity_detail = stream.values
+        return stream.values
 
-    def getClusterSummary(self, lookup):
+    def streamCapacity(self, lookup):
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
-        url = 'https://api.activeiq.netapp.com/v1/clusterview/get-cluster-summary/' + lookup
+        capacity_index = {}
+        return self.streamCapacityIndex(lookup, capacity_index), capacity_index
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.cluster_summary_data = json.loads(response.text)
+    def pollCapacity(self, lookup):
 
-    def getClusterResolver(self, lookup):
+        # The capacity index of a customer, or None when it has not changed since the last poll
+        url = self.apiUrl + '/v2/capacity/details/level/customer/id/' + lookup
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
-        url = 'https://api.activeiq.netapp.com/v1/clusterview/resolver/' + lookup
+        body = self.conditionalGet('capacityDetail', lookup, url)
+        if body is None:
+            return None
+        return self.buildCapacityIndex(self.checked(json.loads(body)))
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.cluster_resolver = json.loads(response.text)
+    def fetchClusterSummary(self, lookup):
 
-    def clusterSearch(self, lookup):
+        url = self.apiUrl + '/v1/clusterview/get-cluster-summary/' + lookup
+
+        return json.loads(self.cachedGet('getClusterSummary', lookup, url))
+
+    def fetchClusterResolver(self, lookup):
+
+        url = self.apiUrl + '/v1/clusterview/resolver/' + lookup
+
+        return json.loads(self.cachedGet('getClusterResolver', lookup, url))
+
+    def fetchClusterSearch(self, lookup):
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
         parseparams = {'name': lookup}
-        url = 'https://api.activeiq.netapp.com/v1/search/aggregate/level/cluster?' + urlencode(parseparams)
+        url = self.apiUrl + '/v1/search/aggregate/level/cluster?' + urlencode(parseparams)
 
-        response = requests.get(url, headers=headers, verify=False)
-        self.cluster_id = json.loads(response.text)
+        return json.loads(self.cachedGet('clusterSearch', lookup, url))
 
-    def nodeEfficiency(self, lookup, **kwargs):
+    def getNodeEfficiency(self, nodes):
 
-        headers = {'accept': 'application/json', 'authorizationToken': self.authToken}
-        url = 'https://api.activeiq.netapp.com/v1/efficiency/summary/level/serial_numbers/id/' + lookup
+        # nodes maps each serial number to the attributes from the resolver, of which the model is kept.
+        # Returns {serial number: node_record}
+        serials = ','.join(nodes.keys())
+        url = self.apiUrl + '/v1/efficiency/summary/level/serial_numbers/id/' + serials
 
-        response = requests.get(url, headers=headers, verify=False)
-        json_data = json.loads(response.text)
-        node_entry = { lookup : {} }
-        for key in json_data['efficiency']['systems']['system'][0]:
-            node_entry[lookup].update({ key : json_data['efficiency']['systems']['system'][0][key] })
-        for key, value in kwargs.items():
-            node_entry[lookup].update({ key : value })
-        self.node_efficiency.update(node_entry)
+        json_data = self.checked(json.loads(self.cachedGet('nodeEfficiency', serials, url)))
+
+        systems = json_data['efficiency']['systems']['system']
+        node_entries = {}
+        if len(nodes) == 1:
+            node_entries[serials] = node_record(systems[0], nodes[serials].get('model'))
+        else:
+            for system in systems:
+                if system['serial_number'] in nodes:
+                    node_entries[system['serial_number']] = node_record(system, nodes[system['serial_number']].get('model'))
+        return node_entries
+
+    def nodeEfficiencyBatch(self, nodes):
+
+        # Collects the nodes into node_efficiency for the command line's cluster output
+        start = time.time()
+        node_entries = self.getNodeEfficiency(nodes)
+        latency = time.time() - start
+
+        with self.efficiencyLock:
+            for serial in node_entries:
+                self.node_efficiency[serial] = node_entries[serial]
+                self.node_latency[serial] = latency
+
+    def inventoryRows(self, system_list=None, capacity_index=None):
+
+        if system_list is None:
+            system_list = self.system_list
+        if capacity_index is None:
+            capacity_index = self.capacity_index
+
+        for result in system_list.get('results', []):
+            yield self.inventoryRow(result, capacity_index)
+
+    def inventoryRow(self, result, capacity_index):
 
-    def clusterNodeUpdate(self, json_data):
+        system = capacity_index.get(result.serial_number)
+        if system is None:
+            return [result.hostname, result.platform_type, result.system_id, result.serial_number,
+                    result.model, result.operating_mode, result.version, None, None, None]
+        return [result.hostname, result.platform_type, result.system_id, result.serial_number,
+                result.model, result.operating_mode, result.version,
+                system.used_capacity_GB, system.percent_capacity, system.allocated_capacity_GB]
 
-        self.nodeEfficiency(json_data['serial'], model=json_data['model'])
+    def fullStatus(self, category):
+
+        return full_status(category)
+
+    def forecastRows(self, capacity_index=None):
+
+        # Rows of hostname, percent used and time to full, least used first
+        if capacity_index is None:
+            capacity_index = self.capacity_index
+
+        rows = []
+        for system in sorted(capacity_index.values(), key=lambda system: system.percent_capacity):
+            rows.append([system.hostname, system.percent_capacity, self.fullStatus(system.category)])
+        return rows
+
+    def overThreshold(self, system):
+
+        return system.percent_capacity is not None and float(system.percent_capacity) >= self.diskThreshold
+
+    def capacityDeltas(self, previous, capacity_index):
+
+        # Rows of hostname, percent, status and change for the systems that are new, removed, or whose percent
+        # used or forecast bucket changed since the previous snapshot. Crossing diskThreshold is reported as such
+        rows = []
+        for serial, system in capacity_index.items():
+            before = previous.get(serial)
+            if before is None:
+                change = 'new'
+            elif before.percent_capacity == system.percent_capacity and before.category == system.category:
+                continue
+            elif self.overThreshold(before) != self.overThreshold(system):
+                change = 'over threshold' if self.overThreshold(system) else 'under threshold'
+            elif before.category != system.category:
+                change = 'forecast'
+            else:
+                change = 'percent'
+            rows.append([system.hostname, system.percent_capacity, self.fullStatus(system.category), change])
+        for serial, system in previous.items():
+            if serial not in capacity_index:
+                rows.append([system.hostname, None, None, 'removed'])
+        rows.sort(key=lambda row: (row[1] is None, row[1]))
+        return rows
+
+    def apiError(self, json_data):
+
+        if "message" in json_data:
+            return str(json_data['message'])
+        if "errors" in json_data:
+            return str(json_data['errors'][0]['message'])
+        return None
+
+    def checked(self, json_data):
+
+        error = self.apiError(json_data)
+        if error:
+            raise api_error(error)
+        return json_data
+
+    def findCustomer(self, name):
+
+        # Returns (customer ID, customer name) of the only customer matching name
+        results = self.getCustomers(name)
+        if len(results) == 0:
+            raise not_found_error("customer %s not found" % name)
+        if len(results) > 1:
+            raise ambiguous_error("Too many matches found, please narrow your search term")
+        return results[0]['id'], results[0]['name']
+
+    def resolveCustomer(self, lookup):
+
+        # Returns (customer ID, customer name if known) for an ID or a name. An entry of digits is taken as an ID
+        # unless it is written as name:<name>; id:<ID> and name:<name> make either explicit
+        if lookup.startswith('id:'):
+            return lookup[3:], None
+        if lookup.startswith('name:'):
+            return self.findCustomer(lookup[5:])
+        if lookup.isdigit():
+            return lookup, None
+        return self.findCustomer(lookup)
+
+    def syncCustomer(self, lookup):
+
+        lookup_id, customer_name = self.resolveCustomer(lookup)
+        system_list = self.fetchSystemList(lookup_id)
+        error = self.apiError(system_list)
+        if error:
+            return lookup_id, None, error
+        capacity_detail = self.fetchCapacityDetail(lookup_id)
+        error = self.apiError(capacity_detail)
+        if error:
+            return lookup_id, None, error
+        changes = self.store.sync(lookup_id, system_list, self.buildCapacityIndex(capacity_detail), customer_name)
+        return lookup_id, changes, None
+
+    def knownCustomer(self, name):
+
+        # The customer ID a name resolved to before, from an expired cached lookup or the local inventory.
+        # It only lets requests start early; the name is still looked up and decides
+        body = self.cache.lastKnown('customerLookup', name)
+        if body is not None:
+            try:
+                results = json.loads(body).get('results', [])
+            except ValueError:
+                results = []
+            if len(results) == 1:
+                return results[0]['id']
+        if self.store is not None or os.path.exists(self.token.argset.authPath + '/Inventory.db'):
+            customers = [customer for customer in self.inventoryStore().findCustomers(name)
+                         if (customer[1] or '').lower() == name.lower()]
+            if len(customers) == 1:
+                return customers[0][0]
+        return None
+
+    def knownCluster(self, name):
+
+        body = self.cache.lastKnown('clusterSearch', name)
+        if body is None:
+            return None
+        try:
+            results = json.loads(body).get('results', [])
+        except ValueError:
+            return None
+        if len(results) == 0:
+            return None
+        return results[0]['id']
+
+    def speculate(self, graph, lookup_id, guess, function):
+
+        # Starts function(guess) without waiting for lookup_id, the future of the real ID. A right guess saves
+        # the lookup's round trip; a wrong one is dropped and the call is made again for the real ID
+        if guess is None:
+            return graph.call(function, lookup_id)
+        speculative = graph.call(function, guess)
+
+        def confirm(real_id):
+            if real_id == guess:
+                return speculative.result()
+            return function(real_id)
+        return graph.call(confirm, lookup_id)
+
+    def inventoryStore(self):
+
+        # Created once on the root query, so forked queries share one connection that close() releases
+        with self.inflightLock:
+            if self.root.store is None:
+                self.root.store = inventory_store(self.token.argset)
+        self.store = self.root.store
+        return self.store
+
+    def bulkCustomer(self, lookup, forecast=False):
+
+        # Returns (customer id, rows, error message) so one failed customer does not stop the batch
+        lookup_id, customer_name = self.resolveCustomer(lookup)
+
+        if forecast:
+            capacity_detail = self.fetchCapacityDetail(lookup_id)
+            error = self.apiError(capacity_detail)
+            if error:
+                return lookup_id, None, error
+            rows = []
+            for row in self.forecastRows(self.buildCapacityIndex(capacity_detail)):
+                rows.append([lookup_id] + row)
+            return lookup_id, rows, None
+
+        system_list = self.fetchSystemList(lookup_id)
+        error = self.apiError(system_list)
+        if error:
+            return lookup_id, None, error
+        capacity_detail = self.fetchCapacityDetail(lookup_id)
+        error = self.apiError(capacity_detail)
+        if error:
+            return lookup_id, None, error
+        rows = []
+        for row in self.inventoryRows(system_list, self.buildCapacityIndex(capacity_detail)):
+            rows.append([lookup_id] + row)
+        return lookup_id, rows, None
+
+    def findCluster(self, name):
+
+        # Returns the cluster ID of a cluster name
+        search = self.checked(self.fetchClusterSearch(name))
+        if len(search.get('results', [])) == 0:
+            raise not_found_error("cluster %s not found" % name)
+        return search['results'][0]['id']
+
+    def resolveCluster(self, lookup):
+
+        # Returns (cluster lookup, nodes) for a cluster name, ID or node serial number
+        lookup_id = lookup
+        if not lookup.isdigit():
+            lookup_id = self.findCluster(lookup)
+
+        resolver = self.checked(self.fetchClusterResolver(lookup_id))
+        if len(resolver.get('clusters', [])) == 0:
+            raise not_found_error("cluster %s not found" % lookup)
+        return lookup_id, resolver['clusters'][0]['nodes']
+
+    def customerClusters(self, lookup_id):
+
+        # Every clustered ONTAP node of the customer, the sweep resolves each cluster only once
+        serials = []
+        for result in self.getSystems(lookup_id):
+            if result.operating_mode in ('Cluster-Mode', None):
+                serials.append(result.serial_number)
+        return serials
+
+    def clusterSweep(self, lookups):
+
+        # Returns (clusters as dicts of lookup, name, serials and a warning if the summary failed, errors).
+        # Resolution, summary and efficiency run as one pipeline on a shared pool: as soon as a cluster is
+        # resolved its efficiency requests are queued while the next clusters are still being resolved.
+        # Efficiency requests are packed across clusters up to the batch size. Nodes of one cluster are
+        # usually listed next to each other, so the list is split into stretches that are resolved one
+        # lookup at a time each; the later nodes of a cluster are covered before they are reached
+        stretchCount = max(1, self.poolSize // 2)
+        stretchSize = max(1, -(-len(lookups) // stretchCount))
+        stretches = []
+        for x in range(0, len(lookups), stretchSize):
+            stretches.append(collections.deque(lookups[x:x + stretchSize]))
+        idle = list(range(len(stretches)))
+        covered = set()
+        clusters = []
+        queued = {}
+        errors = []
+        running = {}
+        resolving = 0
+        efficiency = 0
+
+        with self.tracer.span('sweep'), ThreadPoolExecutor(max_workers=self.poolSize) as executor:
+            while idle or running or queued:
+                for index in idle:
+                    while stretches[index] and stretches[index][0] in covered:
+                        stretches[index].popleft()
+                    if stretches[index]:
+                        lookup = stretches[index].popleft()
+                        running[executor.submit(self.resolveCluster, lookup)] = ('resolve', (index, lookup))
+                        resolving += 1
+                idle = []
+
+                if queued and (len(queued) >= self.efficiencyBatchSize or efficiency == 0 or resolving == 0):
+                    batch = dict(list(queued.items())[:self.efficiencyBatchSize])
+                    for serial in batch:
+                        del queued[serial]
+                    running[executor.submit(self.nodeEfficiencyBatch, batch)] = ('efficiency', batch)
+                    efficiency += 1
+                    continue
+
+                done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, item = running.pop(future)
+                    try:
+                        result = future.result()
+                    except (activeiq_error, IOError, ValueError, KeyError, IndexError) as exception:
+                        result = None
+                        if kind == 'summary':
+                            # The summary only supplies the display name, so the cluster stays listed under its ID
+                            item['warning'] = str(exception)
+                        else:
+                            errors.append((item[1] if kind == 'resolve' else ','.join(item), str(exception)))
+
+                    if kind == 'resolve':
+                        resolving -= 1
+                        index, lookup = item
+                        idle.append(index)
+                        if result is None:
+                            continue
+                        lookup_id, nodes = result
+                        serials = [node['serial'] for node in nodes]
+                        if covered.intersection(serials):
+                            continue
+                        covered.update(serials)
+                        cluster = {'lookup': lookup, 'name': lookup_id, 'serials': serials}
+                        clusters.append(cluster)
+                        running[executor.submit(self.fetchClusterSummary, lookup_id)] = ('summary', cluster)
+                        for node in nodes:
+                            queued[node['serial']] = { 'model' : node.get('model') }
+                    elif kind == 'summary':
+                        if result is not None and len(result.get('data', [])) > 0:
+                            item['name'] = result['data'][0].get('cluster_name', item['name'])
+                    else:
+                        efficiency -= 1
+
+        return clusters, errors
+
+    def getCustomers(self, name):
+
+        # Customers matching name, as dicts of id, name and count
+        return self.checked(self.fetchCustomerSearch(name)).get('results', [])
+
+    def getSystems(self, lookup_id):
+
+        # Returns [system_record]
+        return self.checked(self.fetchSystemList(lookup_id)).get('results', [])
+
+    def getCapacity(self, lookup_id):
+
+        # Returns {serial number: capacity_record}
+        return self.buildCapacityIndex(self.checked(self.fetchCapacityDetail(lookup_id)))
+
+    def getClusterSummary(self, lookup_id):
+
+        # The summary attributes of a cluster ID as one dict
+        data = self.checked(self.fetchClusterSummary(lookup_id)).get('data', [])
+        return data[0] if len(data) > 0 else {}
+
+    def getInventory(self, lookup):
+
+        # Inventory of a customer ID or name as dicts keyed like the JSON lines output
+        lookup_id = self.resolveCustomer(lookup)[0]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            systems = executor.submit(self.getSystems, lookup_id)
+            capacity = executor.submit(self.getCapacity, lookup_id)
+            rows = list(self.inventoryRows({'results': systems.result()}, capacity.result()))
+        return [row_dict(INVENTORY_COLUMNS, row) for row in rows]
+
+    def getForecast(self, lookup):
+
+        lookup_id = self.resolveCustomer(lookup)[0]
+        return [row_dict(FORECAST_COLUMNS, row) for row in self.forecastRows(self.getCapacity(lookup_id))]
+
+    def clusterResult(self, lookup_id, summary, nodes, node_entries):
+
+        # Combines the summary attributes and node records of getCluster into its result
+        rows = []
+        total_efficiency = 0.0
+        for node in nodes:
+            if node['serial'] in node_entries:
+                entry = node_entries[node['serial']]
+                total_efficiency = total_efficiency + float(entry.efficiency)
+                rows.append(row_dict(NODE_COLUMNS, [entry.hostname, entry.serial_number, entry.model, entry.efficiency]))
+        average_efficiency = None
+        if len(rows) > 0:
+            average_efficiency = total_efficiency / len(rows)
+        return {'cluster_id': lookup_id, 'summary': summary, 'nodes': rows,
+                'average_efficiency': average_efficiency}
+
+    def efficiencyBatches(self, nodes):
+
+        batches = []
+        for x in range(0, len(nodes), self.efficiencyBatchSize):
+            batch = {}
+            for node in nodes[x:x + self.efficiencyBatchSize]:
+                batch[node['serial']] = { 'model' : node.get('model') }
+            batches.append(batch)
+        return batches
+
+    def getCluster(self, lookup):
+
+        # Summary, node efficiency and average efficiency of a cluster name, ID or node serial number
+        lookup_id, nodes = self.resolveCluster(lookup)
+        batches = self.efficiencyBatches(nodes)
+        node_entries = {}
+        with ThreadPoolExecutor(max_workers=min(self.poolSize, len(batches) + 1)) as executor:
+            summary = executor.submit(self.getClusterSummary, lookup_id)
+            for future in [executor.submit(self.getNodeEfficiency, batch) for batch in batches]:
+                node_entries.update(future.result())
+        return self.clusterResult(lookup_id, summary.result(), nodes, node_entries)
+
+class async_client:
+
+    # asyncio front end to activeiq_client. The HTTP stack is blocking, so each call runs on a thread pool
+    # sized like the connection pool, and calls awaited together overlap like the CLI's threaded fetches
+
+    def __init__(self, client, executor=None):
+
+        self.client = client
+        self.executor = executor
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=client.poolSize)
+
+    async def call(self, method, *args):
+
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def getCustomers(self, name):
+        return await self.call(self.client.getCustomers, name)
+
+    async def resolveCustomer(self, lookup):
+        return await self.call(self.client.resolveCustomer, lookup)
+
+    async def getSystems(self, lookup_id):
+        return await self.call(self.client.getSystems, lookup_id)
+
+    async def getCapacity(self, lookup_id):
+        return await self.call(self.client.getCapacity, lookup_id)
+
+    async def getClusterSummary(self, lookup_id):
+        return await self.call(self.client.getClusterSummary, lookup_id)
+
+    async def resolveCluster(self, lookup):
+        return await self.call(self.client.resolveCluster, lookup)
+
+    async def getNodeEfficiency(self, nodes):
+        return await self.call(self.client.getNodeEfficiency, nodes)
+
+    async def getInventory(self, lookup):
+
+        import asyncio
+        lookup_id = (await self.resolveCustomer(lookup))[0]
+        systems, capacity = await asyncio.gather(self.getSystems(lookup_id), self.getCapacity(lookup_id))
+        return [row_dict(INVENTORY_COLUMNS, row) for row in self.client.inventoryRows({'results': systems}, capacity)]
+
+    async def getForecast(self, lookup):
+
+        lookup_id = (await self.resolveCustomer(lookup))[0]
+        capacity = await self.getCapacity(lookup_id)
+        return [row_dict(FORECAST_COLUMNS, row) for row in self.client.forecastRows(capacity)]
+
+    async def getCluster(self, lookup):
+
+        import asyncio
+        lookup_id, nodes = await self.resolveCluster(lookup)
+        results = await asyncio.gather(self.getClusterSummary(lookup_id),
+                                       *[self.getNodeEfficiency(batch) for batch in self.client.efficiencyBatches(nodes)])
+        node_entries = {}
+        for entries in results[1:]:
+            node_entries.update(entries)
+        return self.client.clusterResult(lookup_id, results[0], nodes, node_entries)
+
+    def close(self):
+
+        self.executor.shutdown()
+        self.client.close()
+
+def connect(authPath=None, apiUrl=None, refreshToken=None, **options):
+
+    # Returns an activeiq_client. options are parse_args attributes such as poolSize or noCacheFlag;
+    # refreshToken is saved to authPath first, otherwise a refresh token must already be there
+    argset = parse_args()
+    if authPath is not None:
+        argset.authPath = authPath
+    if apiUrl is not None:
+        argset.apiUrl = apiUrl
+    for name in options:
+        if not hasattr(argset, name):
+            raise TypeError("unknown option %s" % name)
+        setattr(argset, name, options[name])
+
+    auth = auth_token(argset)
+    if refreshToken is not None:
+        if not os.path.isdir(argset.authPath):
+            os.makedirs(argset.authPath)
+        auth.writeTokenFile(auth.refreshTokenFile, refreshToken)
+    elif not os.path.exists(auth.refreshTokenFile):
+        raise token_error("Refresh token not found in %s" % argset.authPath)
+    return activeiq_client(auth)
+
+class activeiq(activeiq_client):
 
     def lookup(self, lookup, output=False):
 
-        self.customerLookup(lookup)
+        with self.tracer.span('lookup'):
+            self.customer_data = self.fetchCustomerSearch(lookup)
 
+        self.checked(self.customer_data)
         for key in self.customer_data:
-            if key == "message":
-                print("Lookup Error: " + self.customer_data[key])
-                sys.exit(1)
             if key == "results":
                 for result in self.customer_data[key]:
                     self.id.append(result['id'])
@@ -268,211 +2218,391 @@ class activeiq:
                         print("Count: " + result['count'])
                         print("ID:    " + result['id'])
 
-    def inventory(self, lookup, name=False):
-
-        if name is True:
-            self.lookup(lookup)
-            if len(self.id) > 1:
-                print("Too many matches found, please narrow your search term")
-                sys.exit(1)
-            lookup_id = self.id[0]
-        else:
-            lookup_id = lookup
+    def lookupId(self, lookup):
 
-        listThread = threading.Thread(target=self.systemList, args=(lookup_id,))
-        capacityThread = threading.Thread(target=self.capacityDetail, args=(lookup_id,))
-        listThread.start()
-        capacityThread.start()
-        listThread.join()
-        capacityThread.join()
+        self.lookup(lookup)
+        if len(self.id) == 0:
+            raise not_found_error("customer %s not found" % lookup)
+        if len(self.id) > 1:
+            raise ambiguous_error("Too many matches found, please narrow your search term")
+        return self.id[0]
 
-        printLineNum = 1
+    def inventory(self, lookup, name=False):
 
-        for key in self.system_list:
-            if key == "message":
-                print("Error: " + self.system_list[key])
-                sys.exit(1)
-            if key == "results":
-                for result in self.system_list[key]:
-                    system_used = 'N/A'
-                    system_percent = 'N/A'
-                    system_allocated = 'N/A'
-                    for key in self.capacity_detail:
-                        if key == "message":
-                            print("Error: " + self.capacity_detail[key])
-                            sys.exit(1)
-                        if key == "capacity":
-                            stillSearching = 1
-                            for detail in self.capacity_detail[key]:
-                                for category in self.capacity_detail[key][detail]:
-                                    if stillSearching == 0:
-                                        break
-                                    for system in self.capacity_detail[key][detail][category]:
-                                        if (system['serial_number'] == result['serial_number']):
-                                            system_used = str(system['used_capacity_GB'])
-                                            system_percent = str(system['percent_capacity'])
-                                            system_allocated = str(system['allocated_capacity_GB'])
-                                            stillSearching = 0
-                                            break
-                    if self.textFormatFlag:
-                        if printLineNum == 1:
-                            print('%s %s %s %s %s %s %s %s %s %s' % (
-                                'Hostname'.ljust(20), 'Platform'.ljust(20),
-                                'System ID'.ljust(40), 'Serial'.ljust(20),
-                                'Model'.ljust(15), 'Mode'.ljust(15),
-                                'Version'.ljust(10), 'Used'.ljust(12), 'Percent'.ljust(12),
-                                'Allocated'.ljust(12)))
-                            printLineNum += 1
-                        else:
-                            print('%s %s %s %s %s %s %s %s %s %s' % (
-                                str(result['hostname']).ljust(20), str(result['platform_type']).ljust(20),
-                                str(result['system_id']).ljust(40), str(result['serial_number']).ljust(20),
-                                str(result['model']).ljust(15), str(result['operating_mode']).ljust(15),
-                                str(result['version']).ljust(10), str(system_used).ljust(12),
-                                str(system_percent).ljust(12),
-                                str(system_allocated).ljust(12)))
+        if self.streamFlag:
+            if name is True:
+                lookup = self.lookupId(lookup)
+            self.inventoryStream(lookup)
+            return
+
+        # With a name, both requests start for the ID it resolved to before while the name is looked up
+        with self.tracer.span('fetch'), call_graph(self.poolSize) as graph:
+            lookup_id, guess = lookup, None
+            if name is True:
+                lookup_id = graph.call(self.lookupId, lookup)
+                guess = self.knownCustomer(lookup)
+            system_list = self.speculate(graph, lookup_id, guess, self.fetchSystemList)
+            capacity = self.speculate(graph, lookup_id, guess, self.fetchCapacity)
+            self.system_list = system_list.result()
+            self.capacity_detail, self.capacity_index = capacity.result()
+
+        self.checked(self.system_list)
+        self.checked(self.capacity_detail)
+
+        with self.tracer.span('join'):
+            rows = list(self.inventoryRows())
+
+        with self.tracer.span('output'):
+            writer = self.writer(INVENTORY_COLUMNS, 'csv')
+            for row in rows:
+                writer.row(row)
+            writer.flush()
+
+    def writer(self, columns, defaultFormat, header=True, separator=' '):
+
+        return make_writer(self.outputFormat or defaultFormat, columns, self.outputStream, header=header, separator=separator)
+
+    def inventoryStream(self, lookup_id):
+
+        # Rows are written as soon as their capacity record has been parsed, the rest once the capacity stream ends
+        capacity_index = {}
+        self.capacity_index = capacity_index
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            capacity = executor.submit(self.streamCapacityIndex, lookup_id, capacity_index)
+
+            writer = self.writer(INVENTORY_COLUMNS, 'csv')
+
+            pending = []
+            with self.tracer.span('systemList', 'endpoint', lookup=lookup_id, stream=True):
+                stream = self.streamSystemList(lookup_id)
+                for keys, result in stream.items(['results']):
+                    result = system_record(result)
+                    if result.serial_number in capacity_index:
+                        writer.row(self.inventoryRow(result, capacity_index))
+                    elif capacity.done():
+                        # A failed capacity stream raises here rather than leaving rows without capacity
+                        capacity.result()
+                        writer.row(self.inventoryRow(result, capacity_index))
                     else:
-                        if printLineNum == 1:
-                            print("Hostname," + "Platform,"
-                                  + "SystemID," + "Serial,"
-                                  + "Model," + "Mode,"
-                                  + "Version," + "Used,"
-                                  + "Percent," + "Allocated")
-                            printLineNum += 1
-                        else:
-                            print(result['hostname'] + ","
-                                  + result['platform_type'] + ","
-                                  + result['system_id'] + ","
-                                  + result['serial_number'] + ","
-                                  + result['model'] + ","
-                                  + result['operating_mode'] + ","
-                                  + result['version'] + ","
-                                  + system_used + ","
-                                  + system_percent + ","
-                                  + system_allocated)
+                        pending.append(result)
+            with self.tracer.span('wait'):
+                capacity_detail = capacity.result()
 
-    def disk(self, lookup, name=False):
+        self.checked(stream.values)
+        self.checked(capacity_detail)
 
-        if name is True:
-            self.lookup(lookup)
-            if len(self.id) > 1:
-                print("Too many matches found, please narrow your search term")
-            lookup_id = self.id[0]
-        else:
-            lookup_id = lookup
+        with self.tracer.span('output'):
+            for result in pending:
+                writer.row(self.inventoryRow(result, capacity_index))
+            writer.flush()
 
-        self.capacityDetail(lookup_id)
+    def recordHistory(self, store, lookup_id, capacity_index):
 
-        forecast_data = { 'results' : [] }
-        sorted_data = {}
-        for key in self.capacity_detail:
-            if key == "message":
-                print("Error: " + self.capacity_detail[key])
-                sys.exit(1)
-            if key == "capacity":
-                for detail in self.capacity_detail[key]:
-                    for category in self.capacity_detail[key][detail]:
-                        if category == "current_90":
-                            fullStatus = "Currently Full"
-                        elif category == "1_month_90":
-                            fullStatus = "1 Month To Full"
-                        elif category == "3_months_90":
-                            fullStatus = "3 Months To Full"
-                        elif category == "6_months_90":
-                            fullStatus = "6 Months To Full"
-                        else:
-                            fullStatus = "More Than 6 Months To Full"
-                        for system in self.capacity_detail[key][detail][category]:
-                            system_entry = {}
-                            system_hostname = { 'hostname' : system['hostname'] }
-                            system_capacity_percent = { 'capacity' : system['percent_capacity'] }
-                            system_full_status = { 'status' : fullStatus }
-                            system_entry.update(system_hostname)
-                            system_entry.update(system_capacity_percent)
-                            system_entry.update(system_full_status)
-                            forecast_data['results'].append(system_entry)
-
-        sorted_data['results'] = sorted(forecast_data['results'], key=lambda k: k['capacity'], reverse=False)
-
-        for x in range(len(sorted_data['results'])):
-            if x == 0:
-                print("%s %s %s" % ('Hostname'.ljust(25),
-                                    'Percent'.ljust(10),
-                                    'Time To Full'))
-            print("%s %s %s" % (str(sorted_data['results'][x]['hostname']).ljust(25),
-                                str(sorted_data['results'][x]['capacity']).ljust(10),
-                                str(sorted_data['results'][x]['status'])))
+        with self.tracer.span('history'):
+            store.sync(lookup_id, None, capacity_index)
 
-    def cluster(self, lookup, name=False):
+    def disk(self, lookup, name=False):
 
-        if name is True:
-            self.clusterSearch(lookup)
-            if len(self.cluster_id['results']) == 0:
-                print("Error: cluster %s not found" % lookup)
-                sys.exit(1)
-            lookup_id = self.cluster_id['results'][0]['id']
+        # The capacity request starts like inventory's, and the inventory store is opened alongside it.
+        # The history is written while the forecast is printed, only --trend has to wait for it
+        with call_graph(self.poolSize) as graph:
+            with self.tracer.span('fetch'):
+                lookup_id, guess = lookup, None
+                if name is True:
+                    lookup_id = graph.call(self.lookupId, lookup)
+                    guess = self.knownCustomer(lookup)
+                store = graph.call(self.inventoryStore)
+                if self.streamFlag:
+                    capacity = self.speculate(graph, lookup_id, guess, self.streamCapacity)
+                else:
+                    capacity = self.speculate(graph, lookup_id, guess, self.fetchCapacity)
+                capacity_detail, self.capacity_index = capacity.result()
+                if name is True:
+                    lookup_id = lookup_id.result()
+            self.capacity_detail = self.checked(capacity_detail)
+
+            history = graph.call(self.recordHistory, store, lookup_id, self.capacity_index)
+
+            if self.trendFlag:
+                history.result()
+                with self.tracer.span('forecast'):
+                    rows = trend_rows(store.result(), self.diskThreshold, lookup_id)
+                with self.tracer.span('output'):
+                    writer = self.writer(TREND_COLUMNS, 'table')
+                    for row in rows:
+                        writer.row(row[1:])
+                    writer.flush()
+                return
+
+            with self.tracer.span('forecast'):
+                rows = self.forecastRows()
+
+            with self.tracer.span('output'):
+                writer = self.writer(FORECAST_COLUMNS, 'table')
+                for row in rows:
+                    writer.row(row)
+                writer.flush()
+            history.result()
+
+    def watch(self, entries, interval, workers=8):
+
+        # Polls the capacity of every customer each interval and prints only the systems that changed. The snapshots
+        # stay in memory and the session, token and validators are reused, so an unchanged customer costs a 304
+        lookups = []
+        for entry in entries:
+            try:
+                lookups.append(self.resolveCustomer(entry)[0])
+            except (activeiq_error, IOError, ValueError, KeyError) as exception:
+                sys.stderr.write("Error: customer %s: %s\n" % (entry, exception))
+        if len(lookups) == 0:
+            raise not_found_error("no customers to watch")
+
+        writer = self.writer(WATCH_COLUMNS, 'csv')
+        writer.flush()
+        snapshots = {}
+        try:
+            with ThreadPoolExecutor(max_workers=min(workers, len(lookups))) as executor:
+                while True:
+                    start = time.time()
+                    if not self.token.tokenValid():
+                        self.token.renewToken(staleToken=self.token.accessToken)
+
+                    futures = {}
+                    for lookup_id in lookups:
+                        futures[executor.submit(self.pollCapacity, lookup_id)] = lookup_id
+                    for future in as_completed(futures):
+                        lookup_id = futures[future]
+                        try:
+                            capacity_index = future.result()
+                        except (activeiq_error, IOError, ValueError, KeyError) as exception:
+                            sys.stderr.write("Error: customer %s: %s\n" % (lookup_id, exception))
+                            continue
+                        if capacity_index is None:
+                            continue
+                        with self.tracer.span('history'):
+                            self.inventoryStore().sync(lookup_id, None, capacity_index)
+                        for row in self.capacityDeltas(snapshots.get(lookup_id, {}), capacity_index):
+                            writer.row([lookup_id] + row)
+                        snapshots[lookup_id] = capacity_index
+                    writer.flush()
+
+                    time.sleep(max(0.0, interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            # Every completed poll has been flushed, the rows of an interrupted one are dropped
+            pass
+
+    def sync(self, entries, workers=8):
+
+        self.inventoryStore()
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for entry in entries:
+                futures[executor.submit(self.syncCustomer, entry)] = entry
+            for future in as_completed(futures):
+                try:
+                    lookup_id, changes, error = future.result()
+                except (activeiq_error, IOError, ValueError, KeyError) as exception:
+                    lookup_id, changes, error = futures[future], None, str(exception)
+                if error:
+                    failed += 1
+                    sys.stderr.write("Error: customer %s: %s\n" % (lookup_id, error))
+                    continue
+                (system_changed, system_removed), (capacity_changed, capacity_removed) = changes
+                print("Customer %s: %d systems updated, %d removed; %d capacity records updated, %d removed"
+                      % (lookup_id, system_changed, system_removed, capacity_changed, capacity_removed))
+
+        # The exit skips the interpreter's own flush, so the report of the customers that synced is written first
+        sys.stdout.flush()
+        if failed > 0:
+            sys.exit(1)
+
+    def bulk(self, entries, forecast=False, workers=8):
+
+        if forecast:
+            writer = self.writer([CUSTOMER_COLUMN] + FORECAST_COLUMNS, 'csv')
         else:
-            lookup_id = lookup
-
-        summaryThread = threading.Thread(target=self.getClusterSummary, args=(lookup_id,))
-        resolverThread = threading.Thread(target=self.getClusterResolver, args=(lookup_id,))
-        summaryThread.start()
-        resolverThread.start()
-        summaryThread.join()
-        resolverThread.join()
-
-        for key in self.cluster_summary_data:
-            if key == "message":
-                print("Error: %s" % self.cluster_summary_data[key])
-                sys.exit(1)
-            elif key == "errors":
-                print("Error: %s" % self.cluster_summary_data[key][0]['message'])
-                sys.exit(1)
-            if key == "data":
-                for attribute in self.cluster_summary_data[key][0]:
-                    print("%s = %s" % (str(attribute).ljust(25), self.cluster_summary_data[key][0][attribute]))
-
-        threads = []
-        for key in self.cluster_resolver:
-            if key == "message":
-                print("Error: " + self.cluster_resolver[key])
-                sys.exit(1)
-            if key == "clusters":
-                for x in range(len(self.cluster_resolver[key][0]['nodes'])):
-                    runThread = threading.Thread(target=self.clusterNodeUpdate, args=(self.cluster_resolver[key][0]['nodes'][x],))
-                    runThread.start()
-                    threads.append(runThread)
+            writer = self.writer([CUSTOMER_COLUMN] + INVENTORY_COLUMNS, 'csv')
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for entry in entries:
+                futures[executor.submit(self.bulkCustomer, entry, forecast)] = entry
+            for future in as_completed(futures):
+                try:
+                    lookup_id, rows, error = future.result()
+                except (activeiq_error, IOError, ValueError, KeyError) as exception:
+                    lookup_id, rows, error = futures[future], None, str(exception)
+                if error:
+                    failed += 1
+                    sys.stderr.write("Error: customer %s: %s\n" % (lookup_id, error))
+                    continue
+                for row in rows:
+                    writer.row(row)
+                writer.flush()
+
+        sys.stderr.write("Processed %d customers, %d failed\n" % (len(entries), failed))
+        if failed > 0:
+            sys.exit(1)
+
+    def sweep(self, lookups):
+
+        clusters, errors = self.clusterSweep(lookups)
+        order = dict((lookup, index) for index, lookup in reversed(list(enumerate(lookups))))
+        clusters.sort(key=lambda cluster: order.get(cluster['lookup'], 0))
+
+        with self.tracer.span('output'):
+            writer = self.writer(CLUSTER_COLUMNS, 'table')
+            fleet_total = 0.0
+            fleet_nodes = 0
+            for cluster in clusters:
+                ratios = []
+                for serial in cluster['serials']:
+                    if serial in self.node_efficiency:
+                        ratios.append(float(self.node_efficiency[serial].efficiency))
+                average = None
+                if len(ratios) > 0:
+                    average = round(sum(ratios) / len(ratios), 2)
+                fleet_total = fleet_total + sum(ratios)
+                fleet_nodes = fleet_nodes + len(ratios)
+                writer.row([cluster['name'], cluster['lookup'], len(cluster['serials']), average])
+
+            # csv and jsonl keep one row per cluster, so the fleet average goes to stderr
+            if fleet_nodes > 0:
+                message = ("Fleet Average Efficiency: %.2f (%d clusters, %d nodes)"
+                           % (fleet_total / fleet_nodes, len(clusters), fleet_nodes))
+                if (self.outputFormat or 'table') == 'table':
+                    writer.text(message)
+                else:
+                    sys.stderr.write(message + "\n")
+            writer.flush()
 
-        for x in range(len(threads)):
-            threads[x].join()
+        for cluster in clusters:
+            if 'warning' in cluster:
+                sys.stderr.write("Warning: cluster %s: no summary, listed by ID: %s\n" % (cluster['lookup'], cluster['warning']))
+        for lookup, error in errors:
+            sys.stderr.write("Error: cluster %s: %s\n" % (lookup, error))
+        if len(errors) > 0:
+            sys.exit(1)
 
-        total_efficiency = 0.0
-        for key in self.node_efficiency:
-            total_efficiency = total_efficiency + float(self.node_efficiency[key]['node_overall_efficiency_ratio_without_clone_snapshot'])
-            print("%s = Serial: %s Model: %s Efficiency: %s" % (str(self.node_efficiency[key]['hostname']).ljust(25),
-                                                           str(self.node_efficiency[key]['serial_number']),
-                                                           str(self.node_efficiency[key]['model']).ljust(10),
-                                                           str(self.node_efficiency[key]['node_overall_efficiency_ratio_without_clone_snapshot'])))
+    def cluster(self, lookup, name=False):
 
-        average_efficiency = float(total_efficiency) / float(len(self.node_efficiency))
-        print("Average Efficiency: %.2f" % average_efficiency)
+        # With a name, the summary and resolver start for the cluster ID it resolved to before while it is
+        # searched. The efficiency batches start as soon as the resolver answers, not after the summary
+        with call_graph(self.poolSize) as graph:
+            with self.tracer.span('fetch'):
+                lookup_id, guess = lookup, None
+                if name is True:
+                    lookup_id = graph.call(self.findCluster, lookup)
+                    guess = self.knownCluster(lookup)
+                summary = self.speculate(graph, lookup_id, guess, self.fetchClusterSummary)
+                resolver = self.speculate(graph, lookup_id, guess, self.fetchClusterResolver)
+                self.cluster_resolver = self.checked(resolver.result())
+
+            batches = []
+            for key in self.cluster_resolver:
+                if key == "clusters":
+                    batches = self.efficiencyBatches(self.cluster_resolver[key][0]['nodes'])
+            efficiency = [graph.call(self.nodeEfficiencyBatch, batch) for batch in batches]
+
+            self.cluster_summary_data = self.checked(summary.result())
+            # csv and jsonl keep one row per node, so the summary and average go to stderr
+            table = (self.outputFormat or 'table') == 'table'
+            for key in self.cluster_summary_data:
+                if key == "data":
+                    if table:
+                        writer = self.writer(SUMMARY_COLUMNS, 'table', header=False, separator=' = ')
+                    else:
+                        writer = make_writer('table', SUMMARY_COLUMNS, sys.stderr, header=False, separator=' = ')
+                    for attribute in self.cluster_summary_data[key][0]:
+                        writer.row([attribute, self.cluster_summary_data[key][0][attribute]])
+                    writer.flush()
+
+            with self.tracer.span('efficiency'):
+                for future in efficiency:
+                    future.result()
+
+        if self.verboseFlag:
+            for key in self.node_latency:
+                print("Node %s efficiency request: %.3f s" % (key, self.node_latency[key]))
+
+        with self.tracer.span('output'):
+            writer = self.writer(NODE_COLUMNS, 'table')
+            total_efficiency = 0.0
+            for key in self.node_efficiency:
+                node = self.node_efficiency[key]
+                total_efficiency = total_efficiency + float(node.efficiency)
+                writer.row([node.hostname, node.serial_number, node.model, node.efficiency])
+
+            if len(self.node_efficiency) > 0:
+                average_efficiency = float(total_efficiency) / float(len(self.node_efficiency))
+                if table:
+                    writer.text("Average Efficiency: %.2f" % average_efficiency)
+                else:
+                    sys.stderr.write("Average Efficiency: %.2f\n" % average_efficiency)
+            writer.flush()
 
-def main():
+def read_bulk_file(fileName):
 
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    if fileName == '-':
+        lines = sys.stdin.readlines()
+    else:
+        bulkFd = open(fileName, "r")
+        lines = bulkFd.readlines()
+        bulkFd.close()
 
-    runargs = parse_args()
-    runargs.parse()
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if len(line) > 0 and not line.startswith('#'):
+            entries.append(line)
+    return entries
 
-    myToken = auth_token(runargs)
-    myToken.makeAuthPath()
+def run_command(runargs, query):
 
-    if runargs.refreshFlag:
-        myToken.genToken()
+    # The client raises its errors, the command line reports them and exits
+    try:
+        dispatch_command(runargs, query)
+    except activeiq_error as error:
+        print("Error: %s" % error)
+        sys.exit(1)
 
-    query = activeiq(myToken)
+def dispatch_command(runargs, query):
 
-    if runargs.lookupName is not None and runargs.argCount == 1:
+    if runargs.syncFlag:
+        if runargs.bulkFile:
+            query.sync(read_bulk_file(runargs.bulkFile), workers=runargs.bulkWorkers)
+        elif runargs.lookupName:
+            query.sync(['name:' + runargs.lookupName])
+        elif runargs.id:
+            query.sync([runargs.id])
+        else:
+            print("Error: Sync requires an ID, name or bulk file")
+    elif runargs.watchInterval is not None:
+        if runargs.bulkFile:
+            query.watch(read_bulk_file(runargs.bulkFile), runargs.watchInterval, workers=runargs.bulkWorkers)
+        elif runargs.lookupName:
+            query.watch(['name:' + runargs.lookupName], runargs.watchInterval)
+        elif runargs.id:
+            query.watch([runargs.id], runargs.watchInterval)
+        else:
+            print("Error: Watch requires an ID, name or bulk file")
+    elif runargs.clusterFlag and runargs.sweepFlag:
+        if runargs.bulkFile:
+            query.sweep(read_bulk_file(runargs.bulkFile))
+        elif runargs.id:
+            query.sweep(query.customerClusters(runargs.id))
+        else:
+            print("Error: Cluster sweep requires a customer ID or bulk file")
+    elif runargs.bulkFile:
+        if not (runargs.listFlag or runargs.forecastFlag):
+            print("Error: Bulk mode requires either -l or -f")
+            sys.exit(1)
+        query.bulk(read_bulk_file(runargs.bulkFile), forecast=runargs.forecastFlag and not runargs.listFlag,
+                   workers=runargs.bulkWorkers)
+    elif runargs.lookupName is not None and not (runargs.listFlag or runargs.forecastFlag or runargs.clusterFlag):
         query.lookup(runargs.lookupName, output=True)
     elif runargs.listFlag:
         if runargs.lookupName:
@@ -496,6 +2626,353 @@ def main():
         else:
             print("Error: Cluster lookup requires a name or a serial number")
 
+class thread_output:
+
+    # Stand-in for sys.stdout and sys.stderr in the daemon that sends each handler thread's output to its client
+
+    def __init__(self, default):
+
+        self.default = default
+        self.local = threading.local()
+
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+class socket_output:
+
+    # Frames output as JSON lines of {"fd": 1 or 2, "data": text}
+
+    def __init__(self, wfile, fd, lock):
+
+        self.wfile = wfile
+        self.fd = fd
+        self.lock = lock
+
+    def write(self, text):
+        if text:
+            with self.lock:
+                self.wfile.write(json.dumps({'fd': self.fd, 'data': text}).encode('utf-8') + b'\n')
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.wfile.flush()
+
+class daemon_handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        lock = threading.Lock()
+        done = threading.Event()
+
+        # The client runs the query itself when no acceptance comes, and gives up when the heartbeats stop
+        def heartbeat(reply):
+            while True:
+                try:
+                    with lock:
+                        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                except (OSError, socket.error):
+                    return
+                if done.wait(DAEMON_HEARTBEAT):
+                    return
+                reply = {'alive': True}
+
+        beatThread = threading.Thread(target=heartbeat, args=({'accepted': True},))
+        beatThread.daemon = True
+        beatThread.start()
+        try:
+            status = self.server.daemon.run(request, socket_output(self.wfile, 1, lock), socket_output(self.wfile, 2, lock))
+        finally:
+            done.set()
+            beatThread.join()
+        try:
+            with lock:
+                self.wfile.write(json.dumps({'exit': status}).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except (OSError, socket.error):
+            # The client has gone, e.g. its output pipe was closed
+            pass
+
+class query_daemon:
+
+    def __init__(self, argclass):
+
+        self.argset = argclass
+        self.socketFile = daemon_socket(argclass)
+        auth = auth_token(argclass)
+        auth.makeAuthPath()
+        self.query = activeiq(auth)
+        self.query.cache.memoryEntries = 64
+
+    def run(self, request, stdout, stderr):
+
+        sys.stdout.set(stdout)
+        sys.stderr.set(stderr)
+        status = 0
+        try:
+            runargs = parse_args()
+            runargs.parse(request['argv'])
+            if runargs.outputFile:
+                runargs.outputFile = os.path.join(request['cwd'], runargs.outputFile)
+            if runargs.bulkFile:
+                runargs.bulkFile = os.path.join(request['cwd'], runargs.bulkFile)
+            auth = self.query.token
+            if not auth.tokenValid():
+                auth.renewToken(staleToken=auth.accessToken)
+            query = self.query.fork(runargs, stdout)
+            transport = self.query.transport
+            if runargs.verboseFlag:
+                print("Using the daemon's access token valid until %s" % time.ctime(auth.tokenExpiry(auth.accessToken)))
+                requestCount, handshakeCount = transport.requestCount, transport.handshakeCount()
+            try:
+                run_command(runargs, query)
+            finally:
+                query.close()
+            if runargs.verboseFlag:
+                # The session is the daemon's, so requests of clients running at the same time are counted too
+                print("API requests: %d Connections opened: %d" % (transport.requestCount - requestCount,
+                                                                   transport.handshakeCount() - handshakeCount))
+                transport.scheduler.report()
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                status = 1
+        except Exception as e:
+            sys.stderr.write("Error: %s\n" % e)
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sys.stdout.set(None)
+            sys.stderr.set(None)
+        return status
+
+    def serve(self):
+
+        if os.path.exists(self.socketFile):
+            if daemon_connect(self.socketFile) is not None:
+                print("Error: a daemon is already listening on %s" % self.socketFile)
+                sys.exit(1)
+            os.unlink(self.socketFile)
+
+        server = socketserver.ThreadingUnixStreamServer(self.socketFile, daemon_handler)
+        server.daemon_threads = True
+        server.daemon = self
+        os.chmod(self.socketFile, 0o600)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        print("Active IQ daemon listening on %s" % self.socketFile)
+        sys.stdout.flush()
+        sys.stdout = thread_output(sys.stdout)
+        sys.stderr = thread_output(sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.socketFile)
+            self.query.close()
+
+def daemon_socket(argclass):
+
+    return argclass.authPath + '/aiqcli.sock'
+
+def daemon_connect(socketFile):
+
+    if not os.path.exists(socketFile):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_ACCEPT_TIMEOUT)
+    try:
+        client.connect(socketFile)
+    except (OSError, socket.error):
+        client.close()
+        return None
+    return client
+
+def daemon_request(runargs, argv):
+
+    # Returns the exit status of the query run by the daemon, or None if it should run in this process
+    if runargs.noDaemonFlag or runargs.refreshFlag or runargs.profileFlag or runargs.bulkFile == '-':
+        return None
+    # The daemon's HTTP session has its own pool size, timeouts, retries and rate
+    if runargs.sessionFlag:
+        return None
+    # A watch runs until it is interrupted, which a daemon client could not pass on
+    if runargs.watchInterval is not None:
+        return None
+    if not (runargs.lookupName or runargs.listFlag or runargs.forecastFlag or runargs.clusterFlag):
+        return None
+
+    client = daemon_connect(daemon_socket(runargs))
+    if client is None:
+        return None
+
+    replies = client.makefile('rb')
+    try:
+        client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+        accepted = replies.readline()
+    except (OSError, socket.error):
+        accepted = b''
+    if not accepted:
+        # A hung daemon still accepts connections, so the query runs here instead
+        sys.stderr.write("Warning: daemon not responding, running the query directly\n")
+        replies.close()
+        client.close()
+        return None
+
+    client.settimeout(DAEMON_HEARTBEAT * 3)
+    status = 1
+    while True:
+        try:
+            line = replies.readline()
+        except (OSError, socket.error):
+            sys.stderr.write("Error: daemon stopped responding\n")
+            break
+        if not line:
+            sys.stderr.write("Error: daemon closed the connection\n")
+            break
+        reply = json.loads(line.decode('utf-8'))
+        if 'exit' in reply:
+            status = reply['exit']
+            break
+        if 'fd' not in reply:
+            continue
+        if reply['fd'] == 2:
+            sys.stderr.write(reply['data'])
+        else:
+            sys.stdout.write(reply['data'])
+    replies.close()
+    client.close()
+    sys.stdout.flush()
+    return status
+
+def run_offline(runargs):
+
+    if not os.path.exists(runargs.authPath + '/Inventory.db'):
+        print("Error: no local inventory found, run --sync first")
+        sys.exit(1)
+
+    store = inventory_store(runargs)
+    if runargs.outputFile:
+        stream = open(runargs.outputFile, "w")
+    else:
+        stream = sys.stdout
+
+    if runargs.lookupName is not None and not (runargs.listFlag or runargs.forecastFlag):
+        for customer_id, name, count in store.findCustomers(runargs.lookupName):
+            print("Name:  " + (name or "N/A"))
+            print("Count: " + str(count))
+            print("ID:    " + customer_id)
+        return
+
+    customer_id = runargs.id
+    if runargs.lookupName:
+        customers = store.findCustomers(runargs.lookupName)
+        if len(customers) == 0:
+            print("Error: customer %s not found in the local inventory" % runargs.lookupName)
+            sys.exit(1)
+        if len(customers) > 1:
+            print("Too many matches found, please narrow your search term")
+            sys.exit(1)
+        customer_id = customers[0][0]
+
+    if runargs.listFlag:
+        if customer_id is None:
+            print("Error: Lookup requires either an ID or name")
+            sys.exit(1)
+        writer = make_writer(runargs.outputFormat or 'csv', INVENTORY_COLUMNS, stream)
+        for row in store.inventoryRows(customer_id):
+            writer.row(row)
+        writer.flush()
+    elif runargs.forecastFlag and runargs.trendFlag:
+        if customer_id is None:
+            writer = make_writer(runargs.outputFormat or 'table', [CUSTOMER_COLUMN] + TREND_COLUMNS, stream)
+        else:
+            writer = make_writer(runargs.outputFormat or 'table', TREND_COLUMNS, stream)
+        for row in trend_rows(store, runargs.diskThreshold, customer_id, runargs.overPercent):
+            writer.row(row if customer_id is None else row[1:])
+        writer.flush()
+    elif runargs.forecastFlag:
+        if customer_id is None and runargs.overPercent is None:
+            print("Error: Forecast requires an ID, name or --over")
+            sys.exit(1)
+        if customer_id is None:
+            writer = make_writer(runargs.outputFormat or 'table', [CUSTOMER_COLUMN] + FORECAST_COLUMNS, stream)
+        else:
+            writer = make_writer(runargs.outputFormat or 'table', FORECAST_COLUMNS, stream)
+        for row_customer, hostname, percent, category in store.forecastRows(customer_id, runargs.overPercent):
+            if customer_id is None:
+                writer.row([row_customer, hostname, percent, full_status(category)])
+            else:
+                writer.row([hostname, percent, full_status(category)])
+        writer.flush()
+    else:
+        print("Error: Offline mode supports -n, -l and -f")
+        sys.exit(1)
+
+    if stream is not sys.stdout:
+        stream.close()
+
+def main():
+
+    runargs = parse_args()
+    runargs.parse()
+
+    if runargs.daemonFlag:
+        query_daemon(runargs).serve()
+        return
+
+    if runargs.trendFlag and not import_numpy():
+        print("Error: --trend requires numpy")
+        sys.exit(1)
+
+    if runargs.offlineFlag:
+        run_offline(runargs)
+        return
+
+    status = daemon_request(runargs, sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+    myToken = auth_token(runargs)
+    myToken.makeAuthPath()
+
+    try:
+        query = activeiq(myToken)
+    except activeiq_error as error:
+        print(error)
+        sys.exit(1)
+
+    run_command(runargs, query)
+    query.waitRevalidate()
+
+    if runargs.verboseFlag:
+        query.transport.report()
+
+    if runargs.profileFlag:
+        query.tracer.summary(sys.stderr)
+        if runargs.traceFile:
+            query.tracer.writeChromeTrace(runargs.traceFile)
+    query.close()
+
 if __name__ == '__main__':
 
     try:
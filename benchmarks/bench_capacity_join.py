@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Time the serial number join between systemList and capacityDetail payloads
+#
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aiqcli
+import payloads
+
+
+class stub_token:
+
+    def __init__(self):
+        self.argset = aiqcli.parse_args()
+        self.argset.authPath = tempfile.mkdtemp()
+        self.accessToken = ''
+        self.verboseFlag = False
+
+    def getToken(self):
+        pass
+
+
+def run(count):
+    query = aiqcli.activeiq(stub_token())
+    system_list = payloads.system_list(count)
+    query.capacity_detail = payloads.capacity_detail(count)
+
+    start = time.perf_counter()
+    query.system_list = query.systemRecords(system_list)
+    query.capacity_index = query.buildCapacityIndex(query.capacity_detail)
+    rows = sum(1 for row in query.inventoryRows())
+    elapsed = time.perf_counter() - start
+
+    return rows, elapsed
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+    print("%s %s %s" % ('Systems'.ljust(10), 'Seconds'.ljust(12), 'Usec/System'))
+    for count in sizes:
+        rows, elapsed = run(count)
+        print("%s %s %.3f" % (str(rows).ljust(10), ("%.4f" % elapsed).ljust(12), elapsed * 1000000 / rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Time the time-to-threshold regression over daily capacity samples, and with --store the same forecast read from an
+# inventory store along with recording the next day's sample of every system
+#
+# Usage: bench_forecast.py [systems[,systems...]] [days] [--store]
+#
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aiqcli
+
+
+def samples(systems, days):
+    today = int(time.time() // 86400)
+    rate = numpy.random.default_rng(1).uniform(-1.0, 20.0, systems)
+    day = numpy.tile(numpy.arange(today - days + 1, today + 1, dtype=numpy.float64), systems)
+    used = numpy.repeat(rate, days) * (day - day[0]) + numpy.random.default_rng(2).uniform(0, 50, systems * days) + 1000
+    allocated = numpy.full(systems * days, 20000.0)
+    return numpy.full(systems, days), day, used, allocated
+
+
+def run_regression(systems, days):
+    counts, day, used, allocated = samples(systems, days)
+
+    start = time.perf_counter()
+    growth, forecast = aiqcli.growth_forecast(counts, day, used, allocated, 70)
+    return time.perf_counter() - start
+
+
+def run_store(systems, days):
+    argset = aiqcli.parse_args()
+    argset.authPath = tempfile.mkdtemp()
+    store = aiqcli.inventory_store(argset)
+    counts, day, used, allocated = samples(systems, days)
+
+    serials = ['%012d' % x for x in range(systems)]
+    store.db.executemany('INSERT INTO capacity VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(serial, '1', 'host' + serial, 0, 20000, 5.0, None, '', 0) for serial in serials])
+    store.db.executemany('INSERT INTO capacity_samples VALUES (?, ?, ?, ?)',
+                         zip(numpy.repeat(serials, days).tolist(), day.astype(int).tolist(), used.tolist(), allocated.tolist()))
+    store.db.commit()
+
+    start = time.perf_counter()
+    rows = aiqcli.trend_rows(store, 70)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store.appendHistory([(serial, None, 1100.0, 20000.0, None, None) for serial in serials], int(day[-1]) + 1)
+    store.db.commit()
+    print("Recorded %d samples in %.4f s" % (systems, time.perf_counter() - start))
+    return elapsed
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != '--store']
+    sizes = [int(size) for size in args[0].split(',')] if len(args) > 0 else [1000, 10000, 50000]
+    days = int(args[1]) if len(args) > 1 else 365
+    run = run_store if '--store' in sys.argv else run_regression
+
+    print("%s %s %s %s" % ('Systems'.ljust(10), 'Samples'.ljust(12), 'Seconds'.ljust(12), 'Usec/System'))
+    for systems in sizes:
+        elapsed = run(systems, days)
+        print("%s %s %s %.3f" % (str(systems).ljust(10), str(systems * days).ljust(12), ("%.4f" % elapsed).ljust(12),
+                                 elapsed * 1000000 / systems))
+
+
+if __name__ == '__main__':
+    main()
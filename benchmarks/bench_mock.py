@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Run aiqcli.py against the local mock API and report wall time, request count and peak memory
+#
+
+import getopt
+import sys
+import os
+import time
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import AIQCLI, start_server, stop_server, stats, make_auth_dir
+
+
+def run(apiUrl, authDir, args):
+    # Returns (exit status, wall seconds, peak RSS in MB) for one CLI run
+    command = [sys.executable, AIQCLI, '-a', authDir, '--api_url', apiUrl, '--no_cache', '--output', os.devnull] + args
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    return status, elapsed, rusage.ru_maxrss / 1024.0
+
+
+def main():
+    latency = 0.05
+    sizes = [100, 1000, 10000]
+    nodes = [2, 8, 24]
+    sweeps = [20, 200]
+    rateLimit = 0
+
+    options, remainder = getopt.getopt(sys.argv[1:], 'l:s:n:w:r:', ['latency=', 'sizes=', 'nodes=', 'sweeps=', 'rate='])
+    for opt, arg in options:
+        if opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-s', '--sizes'):
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt in ('-n', '--nodes'):
+            nodes = [int(size) for size in arg.split(',')]
+        elif opt in ('-w', '--sweeps'):
+            sweeps = [int(size) for size in arg.split(',')]
+        elif opt in ('-r', '--rate'):
+            rateLimit = int(arg)
+
+    server, apiUrl = start_server('--latency', latency, '--rate', rateLimit)
+    authDir = make_auth_dir()
+
+    # Mint the access token up front so every case runs with a cached token
+    run(apiUrl, authDir, ['-r'])
+
+    cases = []
+    for size in sizes:
+        cases.append(('-l', size, ['-l', '-i', str(size)]))
+    for size in sizes:
+        cases.append(('-f', size, ['-f', '-i', str(size)]))
+    for size in nodes:
+        cases.append(('-c', size, ['-c', '-s', str(size)]))
+    for size in sweeps:
+        cases.append(('--sweep', size, ['-c', '--sweep', '-i', str(size)]))
+
+    print("Mock API latency %.3f s, rate limit %s" % (latency, "%d/s" % rateLimit if rateLimit > 0 else "none"))
+    print("%s %s %s %s %s" % ('Command'.ljust(8), 'Size'.ljust(8), 'Wall s'.ljust(10), 'Requests'.ljust(10), 'Peak MB'))
+    try:
+        for command, size, args in cases:
+            stats(apiUrl, '/_reset')
+            status, elapsed, peak = run(apiUrl, authDir, args)
+            result = "%s %s %s %s %.1f" % (command.ljust(8), str(size).ljust(8), ("%.3f" % elapsed).ljust(10),
+                                           str(stats(apiUrl, '/_stats')['requests']).ljust(10), peak)
+            if status != 0:
+                result += " (exit status %d)" % (status >> 8)
+            print(result)
+    finally:
+        stop_server(server)
+        shutil.rmtree(authDir)
+
+
+if __name__ == '__main__':
+    main()
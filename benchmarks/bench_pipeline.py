@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Compare the latency of named and ID queries against the mock API between aiqcli.py and another copy of it,
+# e.g. one saved with git show <commit>:aiqcli.py. Wall time divided by the mock latency approximates the
+# number of serialized round trips.
+#
+# Usage: bench_pipeline.py [-l latency] [-r runs] [other_aiqcli.py]
+#
+
+import getopt
+import sys
+import os
+import time
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import AIQCLI, start_server, stop_server, make_auth_dir
+
+
+def best_time(command, runs):
+    # Returns the best of runs wall times in seconds, or None if the command failed
+    best = None
+    for run in range(runs):
+        start = time.time()
+        if subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+            return None
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    latency = 0.2
+    runs = 3
+
+    options, remainder = getopt.getopt(sys.argv[1:], 'l:r:', ['latency=', 'runs='])
+    for opt, arg in options:
+        if opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-r', '--runs'):
+            runs = int(arg)
+    scripts = [('current', AIQCLI)]
+    if len(remainder) > 0:
+        scripts.insert(0, (os.path.basename(remainder[0]), remainder[0]))
+
+    server, apiUrl = start_server('--latency', latency)
+
+    # Name searches return ID 1000, and cluster 8 has 8 nodes
+    cases = [('-l -n', ['-l', '-n', 'acme']),
+             ('-l -i', ['-l', '-i', '1000']),
+             ('-f -n', ['-f', '-n', 'acme']),
+             ('-f -i', ['-f', '-i', '1000']),
+             ('-c -n', ['-c', '-n', '8']),
+             ('-c -s', ['-c', '-s', '8'])]
+
+    print("Mock API latency %.3f s, best of %d runs with --no_cache" % (latency, runs))
+    print("%s %s %s %s" % ('Command'.ljust(8), 'Script'.ljust(20), 'Wall s'.ljust(10), 'Wall / latency'))
+    authDirs = []
+    try:
+        for name, path in scripts:
+            authDir = make_auth_dir()
+            authDirs.append(authDir)
+            common = [sys.executable, path, '-a', authDir, '--api_url', apiUrl, '--no_daemon']
+            subprocess.call(common + ['-r'], stdout=subprocess.DEVNULL)
+
+            for command, args in cases:
+                # One cached run first, so a name has been resolved before as it would be in daily use
+                subprocess.call(common + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                elapsed = best_time(common + ['--no_cache'] + args, runs)
+                if elapsed is None:
+                    print("%s %s failed" % (command.ljust(8), name.ljust(20)))
+                    continue
+                print("%s %s %s %.1f" % (command.ljust(8), name.ljust(20), ("%.3f" % elapsed).ljust(10), elapsed / latency))
+    finally:
+        stop_server(server)
+        for authDir in authDirs:
+            shutil.rmtree(authDir)
+
+
+if __name__ == '__main__':
+    main()
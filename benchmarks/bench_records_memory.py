@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Compare the memory retained by parsed systemList, capacityDetail and efficiency dicts against the slotted records
+#
+
+import os
+import sys
+import json
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aiqcli
+import payloads
+
+
+class stub_token:
+
+    def __init__(self):
+        self.argset = aiqcli.parse_args()
+        self.argset.authPath = tempfile.mkdtemp()
+        self.accessToken = ''
+        self.verboseFlag = False
+
+    def getToken(self):
+        pass
+
+
+def retained(build, text):
+    # Returns the MB still allocated once build() has turned the payload text into what a command keeps
+    tracemalloc.start()
+    kept = build(text)
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return current / 1048576.0
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    query = aiqcli.activeiq(stub_token())
+
+    texts = {'systemList': json.dumps(payloads.system_list(count)),
+             'capacityDetail': json.dumps(payloads.capacity_detail(count)),
+             'nodeEfficiency': json.dumps(payloads.efficiency([payloads.serial(n) for n in range(count)]))}
+
+    def raw_capacity(text):
+        capacity_detail = json.loads(text)
+        capacity_index = {}
+        for detail in capacity_detail['capacity']:
+            for category in capacity_detail['capacity'][detail]:
+                for system in capacity_detail['capacity'][detail][category]:
+                    capacity_index[system['serial_number']] = (system, category)
+        return capacity_detail, capacity_index
+
+    def raw_nodes(text):
+        nodes = {}
+        for system in json.loads(text)['efficiency']['systems']['system']:
+            node = dict(system)
+            node['model'] = 'AFF-A700'
+            nodes[system['serial_number']] = node
+        return nodes
+
+    def record_nodes(text):
+        nodes = {}
+        for system in json.loads(text)['efficiency']['systems']['system']:
+            nodes[system['serial_number']] = aiqcli.node_record(system, 'AFF-A700')
+        return nodes
+
+    cases = [('systemList', json.loads, lambda text: query.systemRecords(json.loads(text))),
+             ('capacityDetail', raw_capacity, lambda text: query.buildCapacityIndex(json.loads(text))),
+             ('nodeEfficiency', raw_nodes, record_nodes)]
+
+    print("%d systems" % count)
+    print("%s %s %s %s" % ('Payload'.ljust(16), 'Dicts MB'.ljust(10), 'Records MB'.ljust(12), 'Ratio'))
+    for name, raw, records in cases:
+        before = retained(raw, texts[name])
+        after = retained(records, texts[name])
+        print("%s %s %s %.2f" % (name.ljust(16), ("%.1f" % before).ljust(10), ("%.1f" % after).ljust(12), before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Measure aiqcli.py start-up: wall time per run and the import time reported by -X importtime
+#
+# Usage: bench_startup.py [runs]
+#
+
+import sys
+import os
+import re
+import time
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import AIQCLI, start_server, stop_server, make_auth_dir
+
+
+def import_times(args):
+    # Returns ({top level module: cumulative usec}, total usec) from one -X importtime run
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', AIQCLI] + args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.communicate()[1].decode('utf-8')
+    modules = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+        if match and len(match.group(3)) == 0:
+            modules[match.group(4)] = int(match.group(2))
+    return modules, sum(modules.values())
+
+
+def wall_time(command, runs):
+    # Returns the best of runs wall times in seconds
+    best = None
+    for run in range(runs):
+        start = time.time()
+        subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    server, apiUrl = start_server()
+    authDir = make_auth_dir()
+    common = ['-a', authDir, '--api_url', apiUrl, '--no_daemon']
+
+    # Fill the token, response cache and inventory so the cached and offline cases make no requests
+    subprocess.call([sys.executable, AIQCLI] + common + ['-r', '-n', 'acme'], stdout=subprocess.DEVNULL)
+    subprocess.call([sys.executable, AIQCLI] + common + ['--sync', '-i', '100'], stdout=subprocess.DEVNULL)
+
+    cases = [('python', None),
+             ('-h', ['-h']),
+             ('cached -n', common + ['-n', 'acme']),
+             ('offline -l', common + ['--offline', '-l', '-i', '100']),
+             ('-l', common + ['--no_cache', '-l', '-i', '100'])]
+
+    print("%s %s %s %s" % ('Case'.ljust(12), 'Wall ms'.ljust(10), 'Import ms'.ljust(10), 'Slowest imports'))
+    try:
+        for name, args in cases:
+            if args is None:
+                print("%s %.1f" % (name.ljust(12), wall_time([sys.executable, '-c', 'pass'], runs) * 1000))
+                continue
+            modules, total = import_times(args)
+            slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:3]
+            print("%s %s %s %s" % (name.ljust(12), ("%.1f" % (wall_time([sys.executable, AIQCLI] + args, runs) * 1000)).ljust(10),
+                                   ("%.1f" % (total / 1000.0)).ljust(10),
+                                   ', '.join("%s %.1f" % (module, usec / 1000.0) for module, usec in slowest)))
+    finally:
+        stop_server(server)
+        shutil.rmtree(authDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Compare peak RSS of parsing a systemList payload with json.loads against the --stream parser
+#
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(mode, fileName):
+    import aiqcli
+
+    rows = 0
+    if mode == 'load':
+        payloadFd = open(fileName, "r")
+        system_list = json.loads(payloadFd.read())
+        payloadFd.close()
+        for result in system_list['results']:
+            line = result['hostname'] + "," + result['serial_number']
+            rows += 1
+    else:
+        payloadFd = open(fileName, "rb")
+        stream = aiqcli.json_stream(aiqcli.decode_chunks(iter(lambda: payloadFd.read(65536), b'')))
+        for keys, result in stream.items(['results']):
+            line = result['hostname'] + "," + result['serial_number']
+            rows += 1
+        payloadFd.close()
+
+    print("%d %d" % (rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def generate(count, fileName):
+    import payloads
+
+    payloadFd = open(fileName, "w")
+    json.dump(payloads.system_list(count), payloadFd)
+    payloadFd.close()
+
+
+def main():
+    # Payloads are generated in a child too, since ru_maxrss of a forked child starts from the parent's RSS
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 50000, 200000]
+
+    print("%s %s %s %s" % ('Systems'.ljust(10), 'Payload MB'.ljust(12), 'json.loads MB'.ljust(15), 'Stream MB'))
+    for count in sizes:
+        payloadFd = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        payloadFd.close()
+        subprocess.check_call([sys.executable, __file__, '--generate', str(count), payloadFd.name])
+
+        peak = {}
+        for mode in ('load', 'stream'):
+            output = subprocess.check_output([sys.executable, __file__, '--child', mode, payloadFd.name])
+            rows, maxrss = output.decode().split()
+            peak[mode] = int(maxrss) / 1024.0
+
+        print("%s %s %s %.1f" % (str(count).ljust(10), ("%.1f" % (os.path.getsize(payloadFd.name) / 1048576.0)).ljust(12),
+                                 ("%.1f" % peak['load']).ljust(15), peak['stream']))
+        os.unlink(payloadFd.name)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--generate':
+        generate(int(sys.argv[2]), sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Compare --watch against re-running -f every interval: response bytes, 304 responses and output rows
+#
+# Usage: bench_watch.py [systems] [polls] [interval] [drift]
+#
+
+import os
+import sys
+import time
+import shutil
+import signal
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import AIQCLI, start_server, stop_server, stats, make_auth_dir
+
+
+def count_rows(output):
+    # Rows without the header line
+    return max(0, len(output.splitlines()) - 1)
+
+
+def main():
+    systems = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    drift = float(sys.argv[4]) if len(sys.argv) > 4 else 5.0
+
+    server, apiUrl = start_server('--drift', drift)
+    authDir = make_auth_dir()
+    common = [sys.executable, AIQCLI, '-a', authDir, '--api_url', apiUrl, '--no_daemon', '--no_cache', '--format', 'csv']
+    subprocess.call(common + ['-r'], stdout=subprocess.DEVNULL)
+
+    print("%d systems, %d polls every %.1f s, a seventh of the systems grow every %.1f s" % (systems, polls, interval, drift))
+    print("%s %s %s %s" % ('Mode'.ljust(8), 'Bytes'.ljust(12), '304s'.ljust(6), 'Rows'))
+    try:
+        stats(apiUrl, '/_reset')
+        rows = 0
+        for poll in range(polls):
+            start = time.time()
+            rows += count_rows(subprocess.check_output(common + ['-f', '-i', str(systems)]).decode('utf-8'))
+            time.sleep(max(0.0, interval - (time.time() - start)))
+        result = stats(apiUrl, '/_stats')
+        print("%s %s %s %d" % ('-f'.ljust(8), str(result['bytes']).ljust(12), str(result['not_modified']).ljust(6), rows))
+
+        stats(apiUrl, '/_reset')
+        outputFile = os.path.join(authDir, 'watch.csv')
+        process = subprocess.Popen(common + ['-i', str(systems), '--watch', str(interval), '--output', outputFile])
+        time.sleep(interval * (polls - 0.5))
+        process.send_signal(signal.SIGINT)
+        process.wait()
+        outputFd = open(outputFile, "r")
+        output = outputFd.read()
+        outputFd.close()
+        result = stats(apiUrl, '/_stats')
+        print("%s %s %s %d" % ('--watch'.ljust(8), str(result['bytes']).ljust(12), str(result['not_modified']).ljust(6),
+                               count_rows(output)))
+    finally:
+        stop_server(server)
+        shutil.rmtree(authDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Check the --stream parser against json.loads with the document split at every offset, and fed one
+# character at a time, so values and numbers cut at a chunk boundary are covered
+#
+# Usage: check_json_stream.py
+#
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aiqcli
+
+DOCUMENTS = [
+    ('{"count": 12.5, "results": [{"a": 1}, {"b": -2.5e+3}]}', ['results']),
+    ('{"results": [1, 22, 333.25, -4e10, 5E-2, 0, -0.0, 7e+1], "total": 1234567890}', ['results']),
+    ('{"flag": true, "none": null, "off": false, "name": "a\\"b\\u00e9,}", "results": [true, null, "x", 1.0]}',
+     ['results']),
+    ('{"status": {"code": 200}, "capacity": {"aff": {"full": [{"serial_number": "1", "percent_capacity": 99.5}],'
+     ' "ok": [{"serial_number": "2", "percent_capacity": 1e-3}]}, "fas": {}}, "ratio": 1.25e2}',
+     ['capacity', '*', '*']),
+    ('{"results": []}', ['results']),
+]
+
+
+def expected(document, path):
+
+    # The elements at path and the other top level values, as json_stream reports them
+    data = json.loads(document)
+    items = []
+    values = {}
+
+    def walk(node, path, keys):
+        for key in node:
+            if path[0] != '*' and path[0] != key:
+                if len(keys) == 0:
+                    values[key] = node[key]
+            elif len(path) == 1:
+                for element in node[key]:
+                    items.append((keys + [key], element))
+            else:
+                walk(node[key], path[1:], keys + [key])
+    walk(data, path, [])
+    return items, values
+
+
+def parse(chunks, path):
+
+    stream = aiqcli.json_stream(chunks)
+    items = list(stream.items(path))
+    return items, stream.values
+
+
+def main():
+
+    checks = 0
+    failures = 0
+    for document, path in DOCUMENTS:
+        want = expected(document, path)
+        splits = [[document[:offset], document[offset:]] for offset in range(len(document) + 1)]
+        splits.append(list(document))
+        for chunks in splits:
+            checks += 1
+            try:
+                got = parse(chunks, path)
+            except ValueError as error:
+                got = error
+            if got != want:
+                failures += 1
+                print("FAIL %r: %s" % (chunks if len(chunks) == 2 else document, got))
+    print("%d checks, %d failed" % (checks, failures))
+    if failures > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
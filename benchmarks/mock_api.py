@@ -0,0 +1,55 @@
+#
+# Set-up shared by the benchmarks that run aiqcli.py against the mock API: a mock server on a free port and an
+# auth directory holding the refresh token it accepts
+#
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import subprocess
+
+if sys.version_info < (3, 0):
+    from urllib2 import urlopen
+else:
+    from urllib.request import urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AIQCLI = os.path.join(BENCH_DIR, '..', 'aiqcli.py')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(*options):
+    # Returns (server process, API URL) once the server listens. It runs in its own process so its payloads
+    # do not count towards the CLI's peak memory; options are mock_server.py options such as '--latency', '0.2'
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_server.py'), '--port', str(port)] +
+                              [str(option) for option in options], stdout=subprocess.PIPE)
+    server.stdout.readline()
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+def stats(apiUrl, path):
+    # The counters of /_stats, or of /_reset after clearing them
+    return json.loads(urlopen(apiUrl + path).read().decode('utf-8'))
+
+
+def make_auth_dir():
+    authDir = tempfile.mkdtemp()
+    refreshTokenFd = open(os.path.join(authDir, 'RefreshToken.txt'), "w")
+    refreshTokenFd.write('mock-refresh-token\n')
+    refreshTokenFd.close()
+    return authDir
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the Active IQ API that serves synthetic payloads
+#
+# Customer and cluster IDs are read as sizes: /systemList/.../id/5000 returns 5000 systems and
+# /clusterview/resolver/8 returns an 8 node cluster, while a node serial number resolves to its two node cluster. Name searches return the name as the ID
+# when it is a number. GET /_stats returns the request count and /_reset clears it. With --rate, requests
+# above that many per second get a 429 response with Retry-After. Responses carry an ETag and Last-Modified
+# and are answered with 304 when they match the request's validators; with --drift, every this many seconds
+# a seventh of the systems grow by one percent of their capacity.
+#
+
+import getopt
+import sys
+import os
+import json
+import gzip
+import time
+import hashlib
+import base64
+import threading
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import payloads
+
+if sys.version_info < (3, 0):
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+else:
+    from urllib.parse import urlparse, parse_qs
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class mock_state:
+
+    latency = 0.0
+    defaultSize = 1000
+    requestCount = 0
+    throttleCount = 0
+    rateLimit = 0
+    notModifiedCount = 0
+    bytesSent = 0
+    drift = 0.0
+    started = time.time()
+    recent = collections.deque()
+    countLock = threading.Lock()
+
+
+def access_token():
+    claims = json.dumps({'exp': int(time.time()) + 3600}).encode('utf-8')
+    return 'mock.' + base64.urlsafe_b64encode(claims).decode('utf-8').rstrip('=') + '.mock'
+
+
+def size_of(value):
+    return int(value) if value.isdigit() else mock_state.defaultSize
+
+
+def drift_step():
+    # Returns (step, time the step started) of the capacity drift
+    if mock_state.drift <= 0:
+        return 0, mock_state.started
+    step = int((time.time() - mock_state.started) // mock_state.drift)
+    return step, mock_state.started + step * mock_state.drift
+
+
+class mock_handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, json_data, status=200, headers=None, modified=None):
+        body = json.dumps(json_data).encode('utf-8')
+        headers = dict(headers or {})
+        if status == 200:
+            headers['ETag'] = '"%s"' % hashlib.md5(body).hexdigest()
+            headers['Last-Modified'] = self.date_time_string(modified or mock_state.started)
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                with mock_state.countLock:
+                    mock_state.notModifiedCount += 1
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with mock_state.countLock:
+            mock_state.bytesSent += len(body)
+
+    def count(self):
+        # Returns False when the request is over the rate limit and has been answered with a 429
+        now = time.time()
+        with mock_state.countLock:
+            mock_state.requestCount += 1
+            while mock_state.recent and mock_state.recent[0] < now - 1.0:
+                mock_state.recent.popleft()
+            throttled = mock_state.rateLimit > 0 and len(mock_state.recent) >= mock_state.rateLimit
+            if throttled:
+                mock_state.throttleCount += 1
+            else:
+                mock_state.recent.append(now)
+        if throttled:
+            self.reply({'message': 'Too many requests'}, status=429, headers={'Retry-After': '1'})
+            return False
+        if mock_state.latency > 0:
+            time.sleep(mock_state.latency)
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path.startswith('/v1/tokens/accessToken'):
+            if not self.count():
+                return
+            self.reply({'access_token': access_token(), 'refresh_token': 'mock-refresh-token'})
+        else:
+            self.reply({'message': 'Not found'}, status=404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        lookup = path.rsplit('/', 1)[-1]
+
+        if path == '/_stats':
+            self.reply({'requests': mock_state.requestCount, 'throttled': mock_state.throttleCount,
+                        'not_modified': mock_state.notModifiedCount, 'bytes': mock_state.bytesSent})
+            return
+        if path == '/_reset':
+            with mock_state.countLock:
+                mock_state.requestCount = 0
+                mock_state.throttleCount = 0
+                mock_state.notModifiedCount = 0
+                mock_state.bytesSent = 0
+            self.reply({'requests': 0, 'throttled': 0, 'not_modified': 0, 'bytes': 0})
+            return
+
+        if not self.count():
+            return
+        if path.startswith('/v1/search/aggregate/level/'):
+            name = parse_qs(url.query).get('name', [''])[0]
+            lookup_id = name if name.isdigit() else str(mock_state.defaultSize)
+            self.reply({'results': [{'id': lookup_id, 'name': name, 'count': lookup_id}]})
+        elif path.startswith('/v1/systemList/aggregate/level/customer/id/'):
+            self.reply(payloads.system_list(size_of(lookup)))
+        elif path.startswith('/v2/capacity/details/level/customer/id/'):
+            step, modified = drift_step()
+            self.reply(payloads.capacity_detail(size_of(lookup), step), modified=modified)
+        elif path.startswith('/v1/clusterview/get-cluster-summary/'):
+            self.reply(payloads.cluster_summary(lookup))
+        elif path.startswith('/v1/clusterview/resolver/') and len(lookup) == 12:
+            self.reply(payloads.cluster_pair(lookup))
+        elif path.startswith('/v1/clusterview/resolver/'):
+            self.reply(payloads.cluster_resolver(size_of(lookup)))
+        elif path.startswith('/v1/efficiency/summary/level/serial_numbers/id/'):
+            self.reply(payloads.efficiency(lookup.split(',')))
+        else:
+            self.reply({'message': 'Not found'}, status=404)
+
+
+def serve(port=0, latency=0.0, defaultSize=1000, rateLimit=0, drift=0.0):
+    mock_state.latency = latency
+    mock_state.drift = drift
+    mock_state.rateLimit = rateLimit
+    mock_state.defaultSize = defaultSize
+    server = ThreadingHTTPServer(('127.0.0.1', port), mock_handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    port = 8089
+    latency = 0.0
+    defaultSize = 1000
+    rateLimit = 0
+    drift = 0.0
+
+    options, remainder = getopt.getopt(sys.argv[1:], 'p:l:s:r:d:', ['port=', 'latency=', 'size=', 'rate=', 'drift='])
+    for opt, arg in options:
+        if opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-s', '--size'):
+            defaultSize = int(arg)
+        elif opt in ('-r', '--rate'):
+            rateLimit = int(arg)
+        elif opt in ('-d', '--drift'):
+            drift = float(arg)
+
+    server = serve(port, latency, defaultSize, rateLimit, drift)
+    print("Mock Active IQ API listening on http://127.0.0.1:%d" % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
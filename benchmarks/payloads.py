@@ -0,0 +1,71 @@
+#
+# Synthetic Active IQ payloads for the benchmarks
+#
+
+CATEGORIES = ['current_90', '1_month_90', '3_months_90', '6_months_90', 'more_than_6_months_90']
+
+
+def serial(n):
+    return "%012d" % (700000000000 + n)
+
+
+def system_list(count):
+    results = []
+    for n in range(count):
+        results.append({'hostname': 'ntaphost%06d' % n,
+                        'platform_type': 'FAS8200',
+                        'system_id': '%010d' % (530000000 + n),
+                        'serial_number': serial(n),
+                        'model': 'FAS8200',
+                        'operating_mode': 'Cluster-Mode',
+                        'version': '9.8P5',
+                        'customer_id': '1234567'})
+    return {'results': results}
+
+
+def capacity_detail(count, step=0):
+    # Every step, a seventh of the systems grow by one percent of their capacity
+    capacity = {'systems': {}}
+    for category in CATEGORIES:
+        capacity['systems'][category] = []
+    for n in range(count):
+        allocated = 10000 + (n % 50) * 1000
+        used = allocated * min(100, n % 100 + (step if n % 7 == 0 else 0)) // 100
+        capacity['systems'][CATEGORIES[n % len(CATEGORIES)]].append({
+            'hostname': 'ntaphost%06d' % n,
+            'serial_number': serial(n),
+            'used_capacity_GB': used,
+            'allocated_capacity_GB': allocated,
+            'percent_capacity': round(used * 100.0 / allocated, 2)})
+    return {'capacity': capacity}
+
+
+def cluster_summary(cluster_id):
+    return {'data': [{'cluster_name': 'ntapclu%s' % cluster_id,
+                      'cluster_id': cluster_id,
+                      'version': '9.8P5',
+                      'node_count': 2}]}
+
+
+def cluster_resolver(count):
+    nodes = []
+    for n in range(count):
+        nodes.append({'serial': serial(n), 'model': 'AFF-A700', 'hostname': 'ntaphost%06d' % n})
+    return {'clusters': [{'nodes': nodes}]}
+
+
+def cluster_pair(serial_number):
+    # The two node cluster that a node serial number from system_list belongs to
+    n = int(serial_number) - 700000000000
+    first = n - n % 2
+    return {'clusters': [{'nodes': [{'serial': serial(first + x), 'model': 'AFF-A700', 'hostname': 'ntaphost%06d' % (first + x)}
+                                    for x in range(2)]}]}
+
+
+def efficiency(serials):
+    systems = []
+    for n, serial_number in enumerate(serials):
+        systems.append({'serial_number': serial_number,
+                        'hostname': 'ntaphost%s' % serial_number[-6:],
+                        'node_overall_efficiency_ratio_without_clone_snapshot': '%.2f' % (1.5 + (n % 10) / 10.0)})
+    return {'efficiency': {'systems': {'system': systems}}}